@@ -0,0 +1,243 @@
+"""Аналитика вовлечённости участников по когортам (NumPy/pandas).
+
+Записи участников разворачиваются в плоские таблицы (ответы, отправки
+сообщений дня, напоминания), и все метрики считаются векторно:
+- задержка ответа после сообщения дня;
+- эффективность напоминаний (ответ в течение интервала после напоминания);
+- воронка по дням исследования и отток.
+
+Админская команда /report в боте, а также офлайн:
+    python analytics.py --data-dir user_data --archive-dir archive [--csv report/]
+"""
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+DAYS = 7
+ANSWER_COLUMNS = ["uid", "kind", "date", "day", "answered_at", "message_id", "media_type"]
+DELIVERY_COLUMNS = ["uid", "day", "sent_at"]
+PARTICIPANT_COLUMNS = ["uid", "cohort", "day", "completed"]
+
+
+def collect_rows(records, today):
+    """Плоские строки из записей участников; без pandas, чтобы шарды отдавали их как JSON.
+
+    today — дата по часам бота для когорты записей без единой даты (см. storage.cohort_of)
+    """
+    from storage import cohort_of
+
+    rows = {"participants": [], "answers": [], "day_sent": [], "reminders": []}
+    for uid, record in records:
+        rows["participants"].append([uid, cohort_of(record, today), record.get("day", 1), bool(record.get("completed"))])
+
+        diary_dates = sorted(record.get("responses", {}))
+        for kind, answers in (("diary", record.get("responses", {})), ("care", record.get("care_responses", {}))):
+            for date, items in answers.items():
+                if isinstance(items, str):
+                    items = [items]
+                # У старых ответов (строк) нет ни дня, ни времени — день восстанавливаем по порядку дат
+                legacy_day = diary_dates.index(date) + 1 if date in diary_dates else None
+                for answer in items:
+                    if isinstance(answer, dict):
+                        media = answer.get("media") or {}
+                        rows["answers"].append([uid, kind, date, answer.get("day") or legacy_day,
+                                                answer.get("answered_at"), answer.get("message_id"),
+                                                media.get("type")])
+                    else:
+                        rows["answers"].append([uid, kind, date, legacy_day, None, None, None])
+
+        for day, sent_at in record.get("day_sent_at", {}).items():
+            rows["day_sent"].append([uid, int(day), sent_at])
+        for reminder in record.get("reminders_sent", []):
+            rows["reminders"].append([uid, reminder.get("day"), reminder.get("at")])
+    return rows
+
+
+def merge_rows(parts):
+    """Объединяет строки, собранные с нескольких шардов"""
+    merged = {"participants": [], "answers": [], "day_sent": [], "reminders": []}
+    for part in parts:
+        for key in merged:
+            merged[key].extend(part.get(key, []))
+    return merged
+
+
+def _timestamps(values):
+    return pd.to_datetime(values, utc=True, errors="coerce", format="ISO8601")
+
+
+def build_frames(rows):
+    participants = pd.DataFrame(rows["participants"], columns=PARTICIPANT_COLUMNS)
+    answers = pd.DataFrame(rows["answers"], columns=ANSWER_COLUMNS)
+    answers["answered_at"] = _timestamps(answers["answered_at"])
+    answers["day"] = pd.to_numeric(answers["day"], errors="coerce")
+    day_sent = pd.DataFrame(rows["day_sent"], columns=DELIVERY_COLUMNS)
+    day_sent["sent_at"] = _timestamps(day_sent["sent_at"])
+    reminders = pd.DataFrame(rows["reminders"], columns=DELIVERY_COLUMNS)
+    reminders["sent_at"] = _timestamps(reminders["sent_at"])
+    return participants, answers, day_sent, reminders
+
+
+def _first_answers(answers):
+    """Первый ответ в дневник на каждый (участник, день)"""
+    diary = answers[(answers["kind"] == "diary") & answers["answered_at"].notna() & answers["day"].notna()]
+    first = diary.groupby(["uid", "day"], as_index=False)["answered_at"].min()
+    first["day"] = first["day"].astype(int)
+    return first
+
+
+def response_latency(answers, day_sent):
+    """Минуты от сообщения дня до первого ответа, по дням"""
+    merged = _first_answers(answers).merge(day_sent, on=["uid", "day"], how="inner")
+    merged["latency_min"] = (merged["answered_at"] - merged["sent_at"]).dt.total_seconds() / 60
+    merged = merged[merged["latency_min"] >= 0]
+    grouped = merged.groupby("day")["latency_min"]
+    return pd.DataFrame({
+        "answers": grouped.size(),
+        "median_min": grouped.median(),
+        "p90_min": grouped.quantile(0.9),
+        "mean_min": grouped.mean(),
+    }).reindex(range(1, DAYS + 1)).rename_axis("day")
+
+
+def reminder_effectiveness(answers, reminders, interval):
+    """Доля напоминаний, после которых участник ответил в течение interval секунд.
+
+    Считается отдельно для 1-го, 2-го и т.д. напоминания за день.
+    """
+    if reminders.empty:
+        return pd.DataFrame(columns=["sent", "answered_within", "rate"]).rename_axis("reminder_no")
+    merged = reminders.dropna(subset=["sent_at"]).merge(_first_answers(answers), on=["uid", "day"], how="left")
+    merged = merged.sort_values("sent_at")
+    merged["reminder_no"] = merged.groupby(["uid", "day"]).cumcount() + 1
+
+    delta = (merged["answered_at"] - merged["sent_at"]).dt.total_seconds().to_numpy()
+    with np.errstate(invalid="ignore"):
+        merged["converted"] = (delta > 0) & (delta <= interval)
+
+    grouped = merged.groupby("reminder_no")["converted"]
+    result = pd.DataFrame({"sent": grouped.size(), "answered_within": grouped.sum()})
+    result["rate"] = result["answered_within"] / result["sent"]
+    return result
+
+
+def day_funnel(answers, day_sent):
+    """Сколько участников дошло до каждого дня, ответило и отсеялось"""
+    first = _first_answers(answers)
+    reached_pairs = pd.concat([day_sent[["uid", "day"]], first[["uid", "day"]]]).drop_duplicates()
+
+    reached_days = reached_pairs["day"].to_numpy(dtype=np.int64)
+    answered_days = first["day"].to_numpy(dtype=np.int64)
+    reached = np.bincount(reached_days[(reached_days >= 1) & (reached_days <= DAYS)], minlength=DAYS + 1)[1:]
+    answered = np.bincount(answered_days[(answered_days >= 1) & (answered_days <= DAYS)], minlength=DAYS + 1)[1:]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        answer_rate = np.where(reached > 0, answered / reached, np.nan)
+        retention = answered / reached[0] if reached[0] else np.full(DAYS, np.nan)
+    # Получили день d, но до дня d+1 не дошли (для последнего дня — не ответили на него)
+    drop_off = reached - np.append(reached[1:], answered[-1])
+
+    return pd.DataFrame({
+        "reached": reached,
+        "answered": answered,
+        "answer_rate": answer_rate,
+        "drop_off": drop_off,
+        "retention": retention,
+    }, index=pd.RangeIndex(1, DAYS + 1, name="day"))
+
+
+def cohort_summary(participants):
+    grouped = participants.groupby("cohort")
+    return pd.DataFrame({
+        "participants": grouped.size(),
+        "completed": grouped["completed"].sum(),
+        "median_day": grouped["day"].median(),
+    })
+
+
+def build_report(rows, reminder_interval=3600):
+    participants, answers, day_sent, reminders = build_frames(rows)
+    media = answers["media_type"].value_counts()
+    return {
+        "participants": len(participants),
+        "answers": len(answers),
+        "media": {str(k): int(v) for k, v in media.items()},
+        "cohorts": cohort_summary(participants),
+        "latency": response_latency(answers, day_sent),
+        "reminders": reminder_effectiveness(answers, reminders, reminder_interval),
+        "funnel": day_funnel(answers, day_sent),
+    }
+
+
+def _fmt(value, digits=0, percent=False):
+    if pd.isna(value):
+        return "—"
+    if percent:
+        return f"{value * 100:.0f}%"
+    return f"{value:.{digits}f}"
+
+
+def format_report(report):
+    """Короткий HTML-отчёт для Telegram"""
+    lines = [
+        "📈 <b>Отчёт по вовлечённости</b>",
+        f"Участников: {report['participants']}, ответов: {report['answers']}",
+    ]
+    if report["media"]:
+        lines.append("Медиа: " + ", ".join(f"{k} {v}" for k, v in report["media"].items()))
+
+    lines += ["", "<b>Воронка по дням</b> (дошли / ответили / отсеялись / удержание)"]
+    for day, row in report["funnel"].iterrows():
+        lines.append(f"День {day}: {row['reached']:.0f} / {row['answered']:.0f} "
+                     f"({_fmt(row['answer_rate'], percent=True)}) / {row['drop_off']:.0f} / "
+                     f"{_fmt(row['retention'], percent=True)}")
+
+    lines += ["", "<b>Задержка ответа после сообщения дня</b> (медиана / p90, мин)"]
+    for day, row in report["latency"].iterrows():
+        if not pd.isna(row["answers"]):
+            lines.append(f"День {day}: {_fmt(row['median_min'])} / {_fmt(row['p90_min'])} ({row['answers']:.0f})")
+
+    lines += ["", "<b>Напоминания</b> (отправлено / ответили в течение интервала)"]
+    if report["reminders"].empty:
+        lines.append("Напоминаний пока не было")
+    for number, row in report["reminders"].head(6).iterrows():
+        lines.append(f"{number}-е: {row['sent']:.0f} / {row['answered_within']:.0f} ({_fmt(row['rate'], percent=True)})")
+
+    lines += ["", "<b>Когорты</b> (участников / завершили)"]
+    for cohort, row in report["cohorts"].tail(8).iterrows():
+        lines.append(f"{cohort}: {row['participants']:.0f} / {row['completed']:.0f}")
+    return "\n".join(lines)
+
+
+def main():
+    from datetime import date
+
+    from storage import ParticipantStore
+
+    parser = argparse.ArgumentParser(description="Аналитика вовлечённости участников")
+    parser.add_argument("--data-dir", default="user_data", help="Каталог с JSON-файлами участников")
+    parser.add_argument("--archive-dir", default="archive", help="Каталог архива завершивших")
+    parser.add_argument("--reminder-interval", type=int, default=3600, help="Окно учёта ответа после напоминания, с")
+    parser.add_argument("--csv", help="Сохранить таблицы отчёта в этот каталог")
+    args = parser.parse_args()
+
+    store = ParticipantStore(args.data_dir, archive_dir=args.archive_dir)
+    # Отдельный скрипт работает по настоящим часам
+    report = build_report(collect_rows(store.iter_all(), date.today().isoformat()), args.reminder_interval)
+
+    print(f"Участников: {report['participants']}, ответов: {report['answers']}, медиа: {report['media']}")
+    for name in ("funnel", "latency", "reminders", "cohorts"):
+        print(f"\n== {name} ==")
+        print(report[name].to_string())
+
+    if args.csv:
+        os.makedirs(args.csv, exist_ok=True)
+        for name in ("funnel", "latency", "reminders", "cohorts"):
+            report[name].to_csv(os.path.join(args.csv, f"{name}.csv"))
+        print(f"\nТаблицы сохранены в {args.csv}")
+
+
+if __name__ == "__main__":
+    main()
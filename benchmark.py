@@ -0,0 +1,256 @@
+"""Сквозной нагрузочный тест бота на фейковом Bot API.
+
+Каждый участник проходит недельный сценарий: /start, Да/Нет, заметка
+(текст или фото), время ЧЧ:ММ. Часть участников отвечает с опозданием
+(получает напоминания), часть пропускает дни. Бот работает на виртуальных
+часах (clock.VirtualClock), так что неделя занимает минуты.
+
+Пример:
+    python benchmark.py --users 1000,10000,100000 --days 7 --budget 600
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+LAZY_SHARE = 0.1
+SKIP_SHARE = 0.05
+# Доля участников, которые блокируют бота после первого дня
+BLOCK_SHARE = 0.02
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def run_scenario(users, days, budget, seed):
+    from telegram import Update
+
+    from clock import VirtualClock
+    from fake_telegram import FakeTelegram, FakeRequest
+
+    main = importlib.import_module("main")
+    logging.getLogger().setLevel(logging.WARNING)
+
+    study_start = datetime(2026, 1, 5, tzinfo=main.TZ)
+    clock = VirtualClock(study_start + timedelta(hours=8))
+    fake = FakeTelegram()
+    application = main.build_application(
+        request=FakeRequest(fake), get_updates_request=FakeRequest(fake), clock=clock
+    )
+    job_queue = application.job_queue
+    await application.initialize()
+    await application.post_init(application)
+
+    rng = random.Random(seed)
+    chat_ids = [100000 + i for i in range(users)]
+    lazy = {chat_id for chat_id in chat_ids if rng.random() < LAZY_SHARE}
+    latencies = []
+    job_seconds = 0.0
+
+    async def send(chat_id, text=None, photo=False, command=False):
+        update = Update.de_json(fake.make_message(chat_id, text, photo=photo, command=command), application.bot)
+        started = time.perf_counter()
+        await application.process_update(update)
+        latencies.append(time.perf_counter() - started)
+
+    async def advance(moment):
+        nonlocal job_seconds
+        started = time.perf_counter()
+        executed = await job_queue.run_until(moment)
+        job_seconds += time.perf_counter() - started
+        return executed
+
+    async def answer_day(chat_id, day):
+        """Один день участника: вопрос про уход, заметка, время следующего дня"""
+        if rng.random() < 0.5:
+            await send(chat_id, "Да")
+            await send(chat_id, "Постирала рубашку, вывела пятно")
+        else:
+            await send(chat_id, "Нет")
+
+        if rng.random() < 0.3:
+            await send(chat_id, f"Фото к дню {day}", photo=True)
+        else:
+            await send(chat_id, f"Заметка участника {chat_id} за день {day}: химчистка, пятно, стирка")
+
+        if day < days:
+            slot = rng.randrange(7 * 4, 22 * 4)
+            await send(chat_id, f"{slot // 4:02d}:{slot % 4 * 15:02d}")
+            return timedelta(minutes=slot * 15)
+        return None
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    days_done = 0
+    jobs_executed = 0
+
+    # День 1: все приходят по /start в 09:00
+    due = {}
+    resume = set()
+    await advance(study_start + timedelta(hours=9))
+    for chat_id in chat_ids:
+        await send(chat_id, "/start", command=True)
+        offset = await answer_day(chat_id, 1)
+        if offset is not None:
+            due[chat_id] = offset
+    days_done = 1
+
+    # Заблокировавшие бота больше не отвечают, а Bot API отдаёт им 403
+    for chat_id in chat_ids:
+        if rng.random() < BLOCK_SHARE:
+            fake.blocked.add(chat_id)
+            due.pop(chat_id, None)
+
+    for day in range(2, days + 1):
+        if time.perf_counter() - started > budget:
+            break
+        date = study_start + timedelta(days=day - 1)
+        jobs_executed += await advance(date + timedelta(minutes=1))
+
+        waiting = {}
+        skipped = set()
+        for chat_id, offset in due.items():
+            if rng.random() < SKIP_SHARE:
+                skipped.add(chat_id)
+                continue
+            delay = timedelta(hours=2) if chat_id in lazy else timedelta()
+            waiting.setdefault(offset + delay, []).append(chat_id)
+        # Кто пропустил вчерашний день, возвращается утром по /start
+        waiting.setdefault(timedelta(hours=9), []).extend(resume)
+
+        due = {}
+        for offset in sorted(waiting):
+            jobs_executed += await advance(date + offset)
+            for chat_id in waiting[offset]:
+                if chat_id in resume:
+                    await send(chat_id, "/start", command=True)
+                next_offset = await answer_day(chat_id, day)
+                if next_offset is not None:
+                    due[chat_id] = next_offset
+        resume = skipped
+        days_done = day
+
+    elapsed = time.perf_counter() - started
+
+    # Полночная проверка пропущенных дней после последнего дня
+    sweep_started = time.perf_counter()
+    jobs_executed += await advance(study_start + timedelta(days=days_done, minutes=5))
+    sweep_seconds = time.perf_counter() - sweep_started
+
+    outbound = application.bot.rate_limiter.report()
+    await application.post_shutdown(application)
+    await application.shutdown()
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return {
+        "users": users,
+        "days": days_done,
+        "complete": days_done == days,
+        "updates": len(latencies),
+        "seconds": round(elapsed, 2),
+        "updates_per_sec": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "jobs_executed": jobs_executed,
+        "job_seconds": round(job_seconds, 3),
+        "sweep_seconds": round(sweep_seconds, 3),
+        "virtual_time": clock.now(main.TZ).isoformat(),
+        "io": dict(main.USER_DATA.io),
+        "cache": main.USER_DATA.metrics(),
+        "inactive": sum(1 for _, u in main.USER_DATA.iter_all() if u.get("inactive")),
+        "outbound": outbound,
+        "rss_mb": round(rss_after / 1024, 1),
+        "rss_growth_mb": round((rss_after - rss_before) / 1024, 1),
+        "api": fake.report(),
+        "compose": dict(importlib.import_module("compose").METRICS),
+    }
+
+
+def run_one(users, days, budget, seed):
+    """Прогон одного масштаба в чистом временном каталоге"""
+    workdir = tempfile.mkdtemp(prefix=f"bench_{users}_")
+    os.environ.setdefault("TOKEN", "123456:BENCHMARK")
+    os.environ.setdefault("ADMIN_ID", "1")
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT_DIR)
+    result = asyncio.run(run_scenario(users, days, budget, seed))
+    result["workdir"] = workdir
+    return result
+
+
+def format_row(r):
+    io = r["io"]
+    mb_written = io.get("bytes_written", 0) / 1024 / 1024
+    mark = "" if r["complete"] else " (прервано)"
+    # Запросов к Bot API сэкономлено склейкой сообщений (compose.py)
+    saved = r["compose"]["parts"] - r["compose"]["sends"]
+    return (
+        f"{r['users']:>8} {r['days']:>4}{mark:<11} {r['updates']:>9} {r['updates_per_sec']:>10.1f} "
+        f"{r['p50_ms']:>8.2f} {r['p99_ms']:>8.2f} {io.get('saves', 0):>8} {mb_written:>10.1f} "
+        f"{r['job_seconds']:>8.2f} {r['rss_mb']:>8.1f} {sum(r['api']['calls'].values()):>9} {saved:>8}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота-дневника")
+    parser.add_argument("--users", default="1000", help="Число участников через запятую, например 1000,10000,100000")
+    parser.add_argument("--days", type=int, default=7)
+    parser.add_argument("--budget", type=float, default=600, help="Лимит времени на один масштаб, секунд")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--cache-size", type=int, help="Размер LRU-кэша участников (CACHE_SIZE)")
+    parser.add_argument("--outbound-rate", type=float, default=0,
+                        help="Лимит исходящих сообщений в секунду (OUTBOUND_RATE), 0 — без ограничения")
+    parser.add_argument("--json", help="Сохранить результаты в JSON-файл")
+    parser.add_argument("--run-one", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        print(json.dumps(run_one(args.run_one, args.days, args.budget, args.seed), ensure_ascii=False))
+        return
+
+    if args.cache_size:
+        os.environ["CACHE_SIZE"] = str(args.cache_size)
+    # Фейковый API не ограничивает скорость, а виртуальные часы не ждут — по умолчанию лимиты снимаем
+    os.environ["OUTBOUND_RATE"] = str(args.outbound_rate)
+    if not args.outbound_rate:
+        os.environ["CHAT_RATE"] = "0"
+    # Все участники пишут «одновременно» по виртуальным часам — входящий лимит тоже снимаем
+    os.environ.setdefault("INBOUND_RATE", "0")
+    os.environ.setdefault("INBOUND_GLOBAL_RATE", "0")
+
+    results = []
+    print(f"{'users':>8} {'days':>4}{'':<11} {'updates':>9} {'upd/sec':>10} {'p50 ms':>8} {'p99 ms':>8} "
+          f"{'saves':>8} {'MB written':>10} {'jobs s':>8} {'RSS MB':>8} {'API calls':>9} {'saved':>8}")
+    for users in (int(u) for u in args.users.split(",")):
+        # Каждый масштаб в отдельном процессе, чтобы память и состояние не смешивались
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--run-one", str(users), "--days", str(args.days),
+             "--budget", str(args.budget), "--seed", str(args.seed)],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        results.append(result)
+        print(format_row(result), flush=True)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
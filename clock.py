@@ -0,0 +1,140 @@
+"""Часы бота: системные и виртуальные (для нагрузочных тестов).
+
+Все функции, зависящие от времени, берут его из main.CLOCK. Виртуальные
+часы вместе с VirtualJobQueue позволяют прогнать неделю исследования
+за секунды: время сдвигается мгновенно, а задания выполняются по порядку.
+"""
+import heapq
+import itertools
+import re
+from datetime import datetime, timedelta
+
+from telegram.ext import Job, JobQueue
+
+
+class SystemClock:
+    """Обычные часы — текущее время системы"""
+
+    def now(self, tz=None):
+        return datetime.now(tz)
+
+
+class VirtualClock:
+    """Часы, которые идут только когда их двигают"""
+
+    def __init__(self, start):
+        if start.tzinfo is None:
+            raise ValueError("VirtualClock требует datetime с часовым поясом")
+        self._now = start
+
+    def now(self, tz=None):
+        if tz is None:
+            return self._now.astimezone().replace(tzinfo=None)
+        return self._now.astimezone(tz)
+
+    def set(self, moment):
+        if moment < self._now:
+            raise ValueError("Виртуальное время не может идти назад")
+        self._now = moment
+
+    def advance(self, seconds):
+        self.set(self._now + timedelta(seconds=seconds))
+
+
+class _VirtualAPSJob:
+    """Минимальная замена apscheduler.job.Job для заданий VirtualJobQueue"""
+
+    def __init__(self, queue, job_id, name, next_run_time):
+        self._queue = queue
+        self.id = job_id
+        self.name = name
+        self.next_run_time = next_run_time
+        self.trigger = "date"
+
+    def remove(self):
+        self._queue._remove(self.id)
+
+    def pause(self):
+        pass
+
+    def resume(self):
+        pass
+
+
+class VirtualJobQueue(JobQueue):
+    """JobQueue на виртуальных часах: задания выполняются в run_until()"""
+
+    __slots__ = ("clock", "_heap", "_jobs", "_by_name", "_ids")
+
+    def __init__(self, clock):
+        super().__init__()
+        self.clock = clock
+        self._heap = []
+        self._jobs = {}
+        self._by_name = {}
+        self._ids = itertools.count()
+
+    def _tz_now(self):
+        return self.clock.now(self.scheduler.timezone)
+
+    def run_once(self, callback, when, data=None, name=None, chat_id=None, user_id=None, job_kwargs=None):
+        job = Job(callback=callback, data=data, name=name, chat_id=chat_id, user_id=user_id)
+        due = self._parse_time_input(when, shift_day=True)
+        job_id = next(self._ids)
+        job._job = _VirtualAPSJob(self, job_id, job.name, due)
+        job._enabled = True
+
+        self._jobs[job_id] = job
+        self._by_name.setdefault(job.name, {})[job_id] = job
+        heapq.heappush(self._heap, (due, job_id))
+        return job
+
+    def _remove(self, job_id):
+        job = self._jobs.pop(job_id, None)
+        if job is not None:
+            same_name = self._by_name.get(job.name)
+            if same_name is not None:
+                same_name.pop(job_id, None)
+                if not same_name:
+                    del self._by_name[job.name]
+
+    def jobs(self, pattern=None):
+        if pattern is None:
+            return tuple(self._jobs.values())
+        regex = re.compile(pattern)
+        return tuple(job for job in self._jobs.values() if job.name and regex.search(job.name))
+
+    def get_jobs_by_name(self, name):
+        return tuple(self._by_name.get(name, {}).values())
+
+    def next_due(self):
+        """Время ближайшего задания или None"""
+        while self._heap and self._heap[0][1] not in self._jobs:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    async def run_until(self, moment):
+        """Двигает часы до moment, по очереди выполняя все задания, которые наступили"""
+        executed = 0
+        while True:
+            due = self.next_due()
+            if due is None or due > moment:
+                break
+            _, job_id = heapq.heappop(self._heap)
+            job = self._jobs.get(job_id)
+            if job is None:
+                continue
+            self._remove(job_id)
+            if due > self.clock.now(due.tzinfo):
+                self.clock.set(due)
+            await job.run(self.application)
+            executed += 1
+        if moment > self.clock.now(moment.tzinfo):
+            self.clock.set(moment)
+        return executed
+
+    async def start(self):
+        pass
+
+    async def stop(self, wait=True):
+        pass
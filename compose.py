@@ -0,0 +1,71 @@
+"""Склейка подряд идущих сообщений бота одному чату в одну отправку.
+
+Сценарий часто шлёт несколько сообщений подряд: приветствие, сообщение
+дня, вопрос про уход. Каждое — отдельный запрос к Bot API и отдельный
+токен в лимитах Telegram, так что утренняя волна стоила в 2–3 раза больше
+запросов, чем нужно. send_composed() объединяет соседние части в одно
+сообщение, если вид от этого не меняется:
+
+- parse_mode совпадает (обычный текст экранируется и встаёт в HTML);
+- клавиатура не больше чем у одной части — она уходит с общим сообщением;
+- общий текст не длиннее лимита Telegram.
+
+Остальные части уходят следом по порядку: параллельные запросы в один чат
+Telegram может доставить в другом порядке.
+"""
+import html
+
+# Лимит Telegram на текст сообщения (для HTML считаем с тегами — с запасом)
+MESSAGE_LIMIT = 4096
+SEPARATOR = "\n\n"
+
+# Сколько частей пришло и сколько запросов ушло (для /queue_stats и нагрузочного теста)
+METRICS = {"parts": 0, "sends": 0}
+
+
+def part(text, parse_mode=None, reply_markup=None):
+    """Одно логическое сообщение сценария"""
+    return {"text": text, "parse_mode": parse_mode, "reply_markup": reply_markup}
+
+
+def _merge(a, b):
+    """Склеенная часть или None, если a и b нельзя отправить одним сообщением"""
+    if a["reply_markup"] is not None and b["reply_markup"] is not None:
+        return None
+    modes = {a["parse_mode"], b["parse_mode"]}
+    if modes == {None, "HTML"}:
+        mode = "HTML"
+        texts = [p["text"] if p["parse_mode"] == "HTML" else html.escape(p["text"]) for p in (a, b)]
+    elif len(modes) == 1:
+        mode = a["parse_mode"]
+        texts = [a["text"], b["text"]]
+    else:
+        # Markdown с чем-то другим без разбора разметки не склеить
+        return None
+    text = SEPARATOR.join(texts)
+    if len(text) > MESSAGE_LIMIT:
+        return None
+    return part(text, mode, a["reply_markup"] if a["reply_markup"] is not None else b["reply_markup"])
+
+
+def compose(parts):
+    """Части по порядку -> отправки по порядку, соседние склеены где можно"""
+    sends = []
+    for p in parts:
+        merged = _merge(sends[-1], p) if sends else None
+        if merged is not None:
+            sends[-1] = merged
+        else:
+            sends.append(dict(p))
+    return sends
+
+
+async def send_composed(bot, chat_id, parts, **kwargs):
+    """Отправляет части одному чату минимальным числом запросов; kwargs — как у send_message"""
+    sends = compose(parts)
+    METRICS["parts"] += len(parts)
+    METRICS["sends"] += len(sends)
+    messages = []
+    for p in sends:
+        messages.append(await bot.send_message(chat_id=chat_id, **p, **kwargs))
+    return messages
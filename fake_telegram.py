@@ -0,0 +1,211 @@
+"""Локальная имитация Telegram Bot API для нагрузочных тестов.
+
+Может работать двумя способами:
+- внутри процесса, как транспорт python-telegram-bot (FakeRequest);
+- как отдельный HTTP-сервер: python fake_telegram.py --port 8081
+  (бот подключается через переменную окружения TELEGRAM_API_URL).
+"""
+import argparse
+import asyncio
+import functools
+import json
+import logging
+import time
+from collections import Counter
+from email.parser import BytesParser
+from urllib.parse import parse_qs, urlsplit
+
+from telegram.request import BaseRequest
+
+import minihttp
+
+logger = logging.getLogger(__name__)
+
+FAKE_FILE_BYTES = b"\xff\xd8\xff\xe0" + b"\x00" * 2048
+
+
+class FakeTelegram:
+    """Состояние фейкового Bot API: исходящие сообщения, файлы и очередь апдейтов"""
+
+    def __init__(self, bot_id=123456, file_bytes=FAKE_FILE_BYTES):
+        self.bot_id = bot_id
+        self.file_bytes = file_bytes
+        self.calls = Counter()
+        self.sent = Counter()
+        self.blocked = set()
+        self._message_id = 0
+        self._update_id = 0
+        self._updates = asyncio.Queue()
+
+    def _next_message_id(self):
+        self._message_id += 1
+        return self._message_id
+
+    def next_update_id(self):
+        self._update_id += 1
+        return self._update_id
+
+    def make_message(self, chat_id, text=None, photo=False, first_name="Участник", command=False):
+        """Собирает JSON входящего сообщения от участника"""
+        message = {
+            "message_id": self._next_message_id(),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": first_name, "username": f"user{chat_id}"},
+        }
+        if photo:
+            message["photo"] = [{
+                "file_id": f"photo_{chat_id}_{message['message_id']}",
+                "file_unique_id": f"u{chat_id}_{message['message_id']}",
+                "width": 640,
+                "height": 480,
+            }]
+            if text:
+                message["caption"] = text
+        elif text is not None:
+            message["text"] = text
+            if command:
+                message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": self.next_update_id(), "message": message}
+
+    def push_update(self, update):
+        self._updates.put_nowait(update)
+
+    async def _get_updates(self, params):
+        timeout = float(params.get("timeout") or 0)
+        updates = []
+        try:
+            updates.append(await asyncio.wait_for(self._updates.get(), timeout=max(timeout, 0.01)))
+        except asyncio.TimeoutError:
+            return []
+        while not self._updates.empty() and len(updates) < int(params.get("limit") or 100):
+            updates.append(self._updates.get_nowait())
+        return updates
+
+    def _sent_message(self, chat_id, params, **extra):
+        message = {
+            "message_id": self._next_message_id(),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "from": {"id": self.bot_id, "is_bot": True, "first_name": "StudyBot"},
+        }
+        if "text" in params:
+            message["text"] = params["text"]
+        message.update(extra)
+        return message
+
+    async def call(self, method, params):
+        """Выполняет метод Bot API и возвращает (HTTP-статус, тело ответа)"""
+        self.calls[method] += 1
+        chat_id = params.get("chat_id")
+        if chat_id is not None and int(chat_id) in self.blocked:
+            return 403, {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}
+
+        if method == "getMe":
+            result = {"id": self.bot_id, "is_bot": True, "first_name": "StudyBot", "username": "study_bot"}
+        elif method == "getUpdates":
+            result = await self._get_updates(params)
+        elif method == "getFile":
+            file_id = params["file_id"]
+            result = {"file_id": file_id, "file_unique_id": file_id, "file_size": len(self.file_bytes),
+                      "file_path": f"photos/{file_id}.jpg"}
+        elif method in ("sendMessage", "sendPhoto", "sendVideo", "sendDocument"):
+            self.sent[method] += 1
+            result = self._sent_message(chat_id, params)
+        else:
+            result = True
+        return 200, {"ok": True, "result": result}
+
+    def report(self):
+        return {"calls": dict(self.calls), "sent": dict(self.sent)}
+
+
+class FakeRequest(BaseRequest):
+    """Транспорт python-telegram-bot, который обращается к FakeTelegram без сети"""
+
+    def __init__(self, fake):
+        self.fake = fake
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        path = urlsplit(url).path
+        if "/file/bot" in path:
+            return 200, self.fake.file_bytes
+        api_method = path.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        status, body = await self.fake.call(api_method, params)
+        return status, json.dumps(body).encode("utf-8")
+
+
+def _parse_body(headers, body):
+    content_type = headers.get("content-type", "")
+    if not body:
+        return {}
+    if content_type.startswith("application/json"):
+        return json.loads(body)
+    if content_type.startswith("multipart/form-data"):
+        message = BytesParser().parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+        params = {}
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            if part.get_filename() is None:
+                params[name] = part.get_payload(decode=True).decode("utf-8")
+        return params
+    return {key: values[0] for key, values in parse_qs(body.decode("utf-8")).items()}
+
+
+def _decode_param(value):
+    if isinstance(value, str) and value[:1] in "{[":
+        try:
+            return json.loads(value)
+        except ValueError:
+            return value
+    return value
+
+
+async def _handle_http(fake, method, target, headers, body):
+    path = urlsplit(target).path
+    if path == "/inject" and method == "POST":
+        fake.push_update(json.loads(body))
+        return 200, json.dumps({"ok": True}).encode()
+    if path.startswith("/file/bot"):
+        return 200, fake.file_bytes
+    if path == "/report":
+        return 200, json.dumps(fake.report()).encode()
+    params = {key: values[0] for key, values in parse_qs(urlsplit(target).query).items()}
+    params.update(_parse_body(headers, body))
+    params = {k: _decode_param(v) for k, v in params.items()}
+    status, result = await fake.call(path.rsplit("/", 1)[-1], params)
+    return status, json.dumps(result).encode("utf-8")
+
+
+async def serve(fake, host="127.0.0.1", port=8081):
+    """Запускает HTTP-сервер фейкового Bot API"""
+    server = await minihttp.serve(functools.partial(_handle_http, fake), host, port)
+    logger.info("Фейковый Bot API слушает http://%s:%s", host, port)
+    return server
+
+
+async def _serve_forever(host, port):
+    server = await serve(FakeTelegram(), host, port)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Фейковый Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    args = parser.parse_args()
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    asyncio.run(_serve_forever(args.host, args.port))
@@ -0,0 +1,85 @@
+"""Ограничение входящих апдейтов: token bucket на чат и общий потолок.
+
+Подключается обработчиком в группе -1, то есть срабатывает раньше всех
+остальных. Апдейт сверх лимита отбрасывается без ответа (ApplicationHandlerStop),
+чтобы один флудящий клиент не занимал диск и CPU всего исследования.
+
+Исключение — апдейты, для которых overflow(update) истинно: например, дневник,
+присланный несколькими сообщениями подряд, склеивается в один ответ, и
+отбрасывать его хвост нельзя. Такие апдейты проходят сверх лимита чата, но
+не сверх общего потолка.
+"""
+import logging
+import time
+
+from telegram import Update
+from telegram.ext import ApplicationHandlerStop, ContextTypes, TypeHandler
+
+from outbox import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class InboundLimiter:
+    """rate апдейтов в секунду на чат (с запасом burst) и не больше global_rate всего; 0 — без ограничения"""
+
+    def __init__(self, rate=1, burst=5, global_rate=200, exempt=(), overflow=None):
+        self.rate = rate
+        self.burst = burst
+        self.exempt = set(exempt)
+        self.overflow = overflow
+        self._global = TokenBucket(global_rate, max(1, global_rate))
+        self._chats = {}
+        self._checked = 0
+        self.metrics = {"passed": 0, "dropped_chat": 0, "dropped_global": 0, "overflow_passed": 0, "coalesced": 0}
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    def allow(self, chat_id, overflow=None):
+        """True, если апдейт чата можно обрабатывать; считает отброшенные.
+
+        overflow — функция без аргументов, её спрашивают только при исчерпанном лимите чата:
+        True пропускает апдейт сверх него.
+        """
+        now = time.monotonic()
+        self._checked += 1
+        if self._checked % 10000 == 0:
+            for chat in [c for c, bucket in self._chats.items() if bucket.full(now)]:
+                del self._chats[chat]
+
+        if chat_id in self.exempt:
+            self.metrics["passed"] += 1
+            return True
+
+        bucket = self._chat_bucket(chat_id)
+        over_limit = bool(bucket.delay(now))
+        if over_limit and not (overflow is not None and overflow()):
+            self.metrics["dropped_chat"] += 1
+            return False
+        if self._global.delay(now):
+            self.metrics["dropped_global"] += 1
+            return False
+
+        if over_limit:
+            self.metrics["overflow_passed"] += 1
+        else:
+            bucket.take(now)
+        self._global.take(now)
+        self.metrics["passed"] += 1
+        return True
+
+    async def check(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        chat = update.effective_chat
+        overflow = (lambda: self.overflow(update)) if self.overflow is not None else None
+        if chat is None or self.allow(chat.id, overflow):
+            return
+        logger.debug("Апдейт %s от чата %s отброшен лимитом", update.update_id, chat.id)
+        raise ApplicationHandlerStop
+
+    def handler(self):
+        """Обработчик для application.add_handler(..., group=-1)"""
+        return TypeHandler(Update, self.check)
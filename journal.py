@@ -0,0 +1,134 @@
+"""Журнал обработанных апдейтов: ответы не теряются при падении и не дублируются.
+
+Файлы участников пишутся раз в FLUSH_INTERVAL, поэтому между записями
+состояние живёт только в памяти. Чтобы его не потерять, после каждого
+апдейта в журнал (JSON Lines, только дозапись) уходит одна строка:
+update_id и полные записи участников, которые он изменил. После очередного
+flush() хранилища делается контрольная точка: окно последних update_id
+атомарно сохраняется в journal.checkpoint, а журнал обнуляется.
+
+При запуске recover() отдаёт хранилищу последнее состояние каждого
+участника из журнала; оборванная последняя строка (процесс убит посреди
+записи) пропускается. Telegram после перезапуска присылает апдейты
+повторно — guard отбрасывает те, чей update_id уже обработан.
+"""
+import json
+import logging
+import os
+from collections import deque
+
+from telegram import Update
+from telegram.ext import ApplicationHandlerStop, TypeHandler
+
+from storage import write_atomic
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateJournal:
+    """Журнал изменений участников с update_id и окно уже обработанных апдейтов"""
+
+    def __init__(self, data_dir, fsync=True, window=10000):
+        self.path = os.path.join(data_dir, "journal.jsonl")
+        self.checkpoint_path = os.path.join(data_dir, "journal.checkpoint")
+        self.fsync = fsync
+        self.window = window
+        self.last_update_id = None
+        self._recent = deque()
+        self._seen = set()
+        self._fd = None
+        self._since_checkpoint = False
+        self.metrics = {"committed": 0, "duplicates": 0, "replayed": 0, "checkpoints": 0}
+
+    def _remember(self, update_id):
+        if update_id is None or update_id in self._seen:
+            return
+        self._seen.add(update_id)
+        self._recent.append(update_id)
+        self._since_checkpoint = True
+        if len(self._recent) > self.window:
+            self._seen.discard(self._recent.popleft())
+        if self.last_update_id is None or update_id > self.last_update_id:
+            self.last_update_id = update_id
+
+    def seen(self, update_id):
+        return update_id in self._seen
+
+    def recover(self):
+        """Контрольная точка и журнал после неё: {uid: последняя запись или None, если участник в архиве}"""
+        try:
+            with open(self.checkpoint_path, "r", encoding="utf-8") as f:
+                checkpoint = json.load(f)
+        except FileNotFoundError:
+            checkpoint = {}
+        for update_id in checkpoint.get("recent", []):
+            self._remember(update_id)
+
+        changes = {}
+        try:
+            with open(self.path, "rb") as f:
+                lines = f.read().split(b"\n")
+        except FileNotFoundError:
+            lines = []
+        for number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Оборванная запись бывает только последней; всё, что до неё, целое
+                logger.warning("Журнал %s: строка %d повреждена, пропускаем", self.path, number)
+                continue
+            changes.update(entry["r"])
+            self._remember(entry.get("u"))
+            self.metrics["replayed"] += 1
+        if changes:
+            logger.info("Из журнала восстановлено участников: %d (записей %d)", len(changes), self.metrics["replayed"])
+        return changes
+
+    def append(self, update_id, records):
+        """Одна строка журнала: апдейт и записи участников после него"""
+        self._remember(update_id)
+        if not records:
+            return
+        line = json.dumps({"u": update_id, "r": records}, ensure_ascii=False, separators=(",", ":")) + "\n"
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        # Один write на строку с O_APPEND: при падении процесса строка либо целая, либо последняя и оборванная
+        os.write(self._fd, line.encode("utf-8"))
+        self._since_checkpoint = True
+        if self.fsync:
+            os.fsync(self._fd)
+        self.metrics["committed"] += 1
+
+    def checkpoint(self):
+        """Все изменения уже в файлах участников: сохраняем окно update_id и обнуляем журнал"""
+        if not self._since_checkpoint:
+            return
+        state = {"last_update_id": self.last_update_id, "recent": list(self._recent)}
+        write_atomic(self.checkpoint_path, json.dumps(state).encode("utf-8"), self.fsync)
+        if self._fd is not None:
+            os.ftruncate(self._fd, 0)
+        elif os.path.exists(self.path):
+            os.truncate(self.path, 0)
+        self._since_checkpoint = False
+        self.metrics["checkpoints"] += 1
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def handlers(self, store):
+        """(guard, commit): для application.add_handler(guard, group=-3) и (commit, group=1)"""
+
+        async def guard(update, context):
+            if self.seen(update.update_id):
+                self.metrics["duplicates"] += 1
+                logger.info("Апдейт %s уже обработан, пропускаем повтор", update.update_id)
+                raise ApplicationHandlerStop
+
+        async def commit(update, context):
+            store.commit(update.update_id)
+
+        return TypeHandler(Update, guard), TypeHandler(Update, commit)
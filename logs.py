@@ -0,0 +1,112 @@
+"""Настройка логирования: запись в фоновом потоке и сводки массовых заданий.
+
+Обработчики вызывают logger как обычно, но в поток stdout пишет
+QueueListener в отдельном потоке — медленный вывод не задерживает цикл
+событий. Формат задаётся LOG_FORMAT=text|json, уровень — LOG_LEVEL.
+
+Для обходов всех участников (восстановление расписания, ночная проверка)
+вместо строки на каждого участника есть BulkLog: он считает события,
+пишет в DEBUG лишь первые несколько строк каждого вида и в конце выводит
+одну сводную строку.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+from collections import Counter
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+# Атрибуты LogRecord, которые не надо дублировать в JSON как дополнительные поля
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись; поля из extra={...} попадают в неё как есть"""
+
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup_logging(level=None, fmt=None, stream=None):
+    """Корневой логгер -> QueueHandler -> QueueListener (фоновый поток) -> stream"""
+    global _listener
+    level = level or os.environ.get("LOG_LEVEL", "INFO")
+    fmt = fmt or os.environ.get("LOG_FORMAT", "text")
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonFormatter() if fmt == "json" else logging.Formatter(TEXT_FORMAT))
+
+    if _listener is not None:
+        _listener.stop()
+    log_queue = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(level)
+    return _listener
+
+
+def stop_logging():
+    """Дописывает всё из очереди (вызывается при выходе)"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_logging)
+
+
+class BulkLog:
+    """Счётчики событий обхода участников и одна сводная строка в конце.
+
+    Первые sample строк каждого события пишутся в DEBUG (ошибки — в WARNING),
+    остальные только считаются.
+    """
+
+    def __init__(self, logger, title, sample=3):
+        self.logger = logger
+        self.title = title
+        self.sample = sample
+        self.counts = Counter()
+        self.started = time.perf_counter()
+
+    def event(self, key, msg=None, *args):
+        self.counts[key] += 1
+        if msg and self.counts[key] <= self.sample and self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(msg, *args)
+
+    def error(self, key, msg, *args):
+        self.counts[key] += 1
+        if self.counts[key] <= self.sample:
+            self.logger.warning(msg, *args)
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started
+        counts = ", ".join(f"{key}={value}" for key, value in sorted(self.counts.items())) or "нет событий"
+        self.logger.info("%s: %s (%.2f с)", self.title, counts, elapsed,
+                         extra={"bulk": self.title, "counts": dict(self.counts), "seconds": round(elapsed, 3)})
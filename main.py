@@ -1,5 +1,9 @@
+import asyncio
+import functools
+import html
 import json
 import logging
+import re
 from datetime import datetime, timedelta, time as dtime
 from zoneinfo import ZoneInfo
 
@@ -12,93 +16,330 @@ from telegram.ext import (
     filters,
 )
 
-from days import *
+from clock import SystemClock
+from outbox import PERMANENT_ERRORS, PriorityRateLimiter, classify_error
+import compose
+from logs import BulkLog, setup_logging
+from tenants import (
+    CURRENT_STUDY,
+    Study,
+    StudyProxy,
+    bind_study,
+    current_study,
+    load_studies,
+    set_default_study,
+    study_handler,
+)
 
 # --- Настройки ---
 import os
-TOKEN = os.environ.get('TOKEN')
-
-if not TOKEN:
-    print("❌ ERROR: TOKEN environment variable is not set!")
-    print("Please set the TOKEN variable on Railway")
-    exit(1)
-ADMIN_ID = os.environ.get('ADMIN_ID')
-
-if not ADMIN_ID:
-    print("⚠️ WARNING: ADMIN_ID not set, admin commands will be disabled")
-    ADMIN_ID = None
-else:
-    try:
-        ADMIN_ID = int(ADMIN_ID)
-        print(f"✅ Admin ID set to: {ADMIN_ID}")
-    except ValueError:
-        print("❌ ERROR: ADMIN_ID must be a number")
-        ADMIN_ID = None
+import time
+TOKEN = None
+ADMIN_ID = None
 BASE_DIR = os.getcwd()
 DATA_FILE = os.path.join(BASE_DIR, "user_data.json")
+DATA_DIR = os.path.join(BASE_DIR, "user_data")
+ARCHIVE_DIR = os.path.join(BASE_DIR, "archive")
+# Шардированный режим (см. shard.py): у каждого воркера свои участники и каталоги данных
+SHARD_INDEX = int(os.environ.get('SHARD_INDEX', 0))
+SHARD_COUNT = int(os.environ.get('SHARD_COUNT', 1))
+SHARD_PORT = int(os.environ.get('SHARD_PORT', 0))
+SHARD_PEERS = [peer for peer in os.environ.get('SHARD_PEERS', '').split(',') if peer]
+if SHARD_COUNT > 1:
+    DATA_DIR = os.path.join(DATA_DIR, f"shard_{SHARD_INDEX}")
+    ARCHIVE_DIR = os.path.join(ARCHIVE_DIR, f"shard_{SHARD_INDEX}")
 MEDIA_DIR = os.path.join(BASE_DIR, "user_media")
 TZ = ZoneInfo("Europe/Moscow")
 REMINDER_INTERVAL = 3600
+CLOCK = SystemClock()
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL')
+# lazy — принимать апдейты сразу, участников и расписание поднимать в фоне; eager — всё до старта
+STARTUP_MODE = os.environ.get('STARTUP_MODE', 'lazy')
 
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.INFO
-)
+setup_logging()
 logger = logging.getLogger(__name__)
 
 YES_NO_KEYBOARD = ReplyKeyboardMarkup([["Да", "Нет"]], one_time_keyboard=True, resize_keyboard=True)
 
+# Данные, сценарий и лимиты текущего исследования (tenants.py): в обычном режиме
+# исследование одно, в режиме STUDIES_CONFIG — своё у каждого бота процесса
+STUDY = StudyProxy()
+SCRIPT = StudyProxy("script")
+USER_DATA = StudyProxy("store")
+SEARCH_INDEX = StudyProxy("search")
+INBOUND_LIMITER = StudyProxy("inbound")
+STATS_CACHE = StudyProxy("stats_cache")
+CACHE_SIZE = int(os.environ.get('CACHE_SIZE', 10000))
+CACHE_TTL = int(os.environ.get('CACHE_TTL', 3600))
+# fsync файлов участников и журнала апдейтов: 0 — переживает падение процесса, но не питания
+FSYNC = os.environ.get('FSYNC', '1') == '1'
+FLUSH_INTERVAL = 5
+# Лимиты исходящих сообщений Telegram: всего в секунду и в секунду на один чат (0 — без ограничения)
+OUTBOUND_RATE = float(os.environ.get('OUTBOUND_RATE', 30))
+CHAT_RATE = float(os.environ.get('CHAT_RATE', 1))
+
+# Входящие апдейты: на чат (с запасом INBOUND_BURST) и общий потолок, 0 — без ограничения
+INBOUND_CONFIG = {
+    "rate": float(os.environ.get('INBOUND_RATE', 1)),
+    "burst": int(os.environ.get('INBOUND_BURST', 5)),
+    "global_rate": float(os.environ.get('INBOUND_GLOBAL_RATE', 200)),
+}
+# JSON-файл со списком исследований (см. tenants.py) — несколько ботов в одном процессе
+STUDIES_CONFIG = os.environ.get('STUDIES_CONFIG')
+# Сообщения, пришедшие в течение этого времени после ответа, дописываются в тот же ответ
+COALESCE_WINDOW = int(os.environ.get('COALESCE_WINDOW', 60))
+STATS_CACHE_TTL = 30
+PROFILE_MAX_SECONDS = 600
+
+
+def load_config():
+    """Читает TOKEN и ADMIN_ID из окружения"""
+    global TOKEN, ADMIN_ID
+    if TOKEN:
+        return
 
-def load_data():
-    if not os.path.exists(DATA_FILE):
-        return {}
-    try:
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception as e:
-        logger.exception("Ошибка при загрузке данных: %s", e)
-        return {}
+    TOKEN = os.environ.get('TOKEN')
+    if not TOKEN:
+        print("❌ ERROR: TOKEN environment variable is not set!")
+        print("Please set the TOKEN variable on Railway")
+        exit(1)
 
+    ADMIN_ID = os.environ.get('ADMIN_ID')
+    if not ADMIN_ID:
+        print("⚠️ WARNING: ADMIN_ID not set, admin commands will be disabled")
+        ADMIN_ID = None
+    else:
+        try:
+            ADMIN_ID = int(ADMIN_ID)
+            print(f"✅ Admin ID set to: {ADMIN_ID}")
+        except ValueError:
+            print("❌ ERROR: ADMIN_ID must be a number")
+            ADMIN_ID = None
 
-def save_data(data):
-    try:
-        with open(DATA_FILE, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        logger.exception("Ошибка при сохранении данных: %s", e)
+    set_default_study(Study(
+        "default", TOKEN,
+        admin_id=ADMIN_ID,
+        data_dir=DATA_DIR,
+        archive_dir=ARCHIVE_DIR,
+        media_dir=MEDIA_DIR,
+        # В шардированном режиме старый файл делит фронт (shard.redistribute)
+        legacy_file=DATA_FILE if SHARD_COUNT <= 1 else None,
+        max_cached=CACHE_SIZE,
+        ttl=CACHE_TTL,
+        inbound=INBOUND_CONFIG,
+        fsync=FSYNC,
+    ))
+
+
+class StartupTimer:
+    """Логирует длительность фаз запуска"""
 
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.last = self.started
 
-USER_DATA = load_data()
-os.makedirs(MEDIA_DIR, exist_ok=True)
+    def phase(self, name):
+        now = time.perf_counter()
+        logger.info("Запуск: %s — %.3f с (с начала %.3f с)", name, now - self.last, now - self.started)
+        self.last = now
+
+
+STARTUP_TIMER = StartupTimer()
+
+
+def save_user(uid, u):
+    USER_DATA.save(uid, u)
+
+
+def set_clock(clock):
+    """Подменяет источник времени (например, на VirtualClock в нагрузочных тестах)"""
+    global CLOCK
+    CLOCK = clock
 
 
 def now_in_tz():
-    return datetime.now(TZ)
+    return CLOCK.now(TZ)
+
+
+def timestamp():
+    """Текущее время для записей участника, например 2026-01-05T09:00:12+03:00"""
+    return now_in_tz().isoformat(timespec="seconds")
+
+
+def record_delivery(uid, day, reminder=False):
+    """Запоминает, когда участнику ушло сообщение дня или напоминание (для /report)"""
+    u = USER_DATA.get(uid)
+    if not u:
+        return
+    if reminder:
+        u.setdefault("reminders_sent", []).append({"day": day, "at": timestamp()})
+    else:
+        # Повторный /start не сдвигает момент первой отправки дня
+        u.setdefault("day_sent_at", {}).setdefault(str(day), timestamp())
+    save_user(uid, u)
+
+
+def deactivate(context, chat_id, reason, log=None):
+    """Участник недоступен навсегда (заблокировал бота, удалил аккаунт) — снимаем все его задания.
+
+    log — BulkLog массового обхода: событие попадёт в его итоговую строку, а не отдельным предупреждением.
+    """
+    uid = str(chat_id)
+    u = USER_DATA.get(uid)
+    if u and not u.get("inactive"):
+        u["inactive"] = True
+        u["inactive_reason"] = reason
+        u["inactive_since"] = timestamp()
+        save_user(uid, u)
+    cancel_jobs(context, chat_id)
+    if log is not None:
+        log.event(f"deactivated_{reason}", "Участник %s недоступен (%s), задания сняты", chat_id, reason)
+    else:
+        logger.warning("Участник %s недоступен (%s), задания сняты", chat_id, reason)
+
+
+def handle_delivery_error(context, chat_id, error, what):
+    """Логирует ошибку доставки; при постоянной ошибке отключает участника. Возвращает вид ошибки"""
+    kind = classify_error(error)
+    if kind in PERMANENT_ERRORS:
+        deactivate(context, chat_id, kind)
+    else:
+        logger.error("Ошибка при отправке (%s) пользователю %s: %s: %s", what, chat_id, kind, error)
+    return kind
+
+
+def reactivate(u):
+    """Участник снова написал боту — значит, сообщения до него доходят"""
+    if u.pop("inactive", None):
+        u.pop("inactive_reason", None)
+        u.pop("inactive_since", None)
+        return True
+    return False
+
+
+def media_ref(message, path=None):
+    """Тип и file_id вложения сообщения, None если вложения нет"""
+    if message.photo:
+        media = {"type": "photo", "file_id": message.photo[-1].file_id}
+    elif message.video:
+        media = {"type": "video", "file_id": message.video.file_id}
+    elif message.document:
+        media = {"type": "document", "file_id": message.document.file_id}
+    else:
+        return None
+    if path:
+        media["path"] = path
+    return media
+
+
+def make_answer(message, day, media=None):
+    """Структурированная запись ответа участника"""
+    if media is None:
+        media = media_ref(message)
+    return {
+        "text": message.text or message.caption or ("" if media else "<медиа-сообщение>"),
+        "day": day,
+        "answered_at": timestamp(),
+        "message_id": message.message_id,
+        "media": media,
+    }
+
+
+def answer_seen(u, message, today):
+    """Сообщение уже сохранено среди сегодняшних ответов (повторная доставка того же апдейта)"""
+    for answers in (u.get("responses", {}).get(today), u.get("care_responses", {}).get(today)):
+        for answer in answers or []:
+            if isinstance(answer, dict) and (answer.get("message_id") == message.message_id
+                                             or message.message_id in answer.get("merged_message_ids", ())):
+                return True
+    return False
+
+
+def coalesce_target(u, today):
+    """Последний ответ дня, к которому можно дописать следующее сообщение, или None"""
+    day_responses = u.get("responses", {}).get(today)
+    if not day_responses or not isinstance(day_responses[-1], dict):
+        return None
+    answer = day_responses[-1]
+    last_at = datetime.fromisoformat(answer.get("updated_at") or answer["answered_at"])
+    if (now_in_tz() - last_at).total_seconds() > COALESCE_WINDOW:
+        return None
+    return answer
+
+
+def coalescible(update):
+    """Текст, который склеится с сегодняшним ответом: входящий лимит его не отбрасывает"""
+    message = update.message
+    if message is None or not message.text or message.text.startswith("/") or update.effective_chat is None:
+        return False
+    u = USER_DATA.peek(str(update.effective_chat.id))
+    today = today_date_str()
+    return bool(u and u.get("answered_today") and u.get("last_response_date") == today
+                and coalesce_target(u, today) is not None)
+
+
+def coalesce_answer(uid, u, message, today):
+    """Дописывает текст к последнему ответу дня, если он пришёл сразу следом.
+
+    Возвращает True, если сообщение склеено с ответом.
+    """
+    if not message.text:
+        return False
+    answer = coalesce_target(u, today)
+    if answer is None:
+        return False
+    day_responses = u["responses"][today]
+
+    answer["text"] = f"{answer['text']}\n{message.text}" if answer["text"] else message.text
+    answer["updated_at"] = timestamp()
+    answer["parts"] = answer.get("parts", 1) + 1
+    answer.setdefault("merged_message_ids", []).append(message.message_id)
+    save_user(uid, u)
+    SEARCH_INDEX.add(uid, "diary", today, answer.get("day"), len(day_responses) - 1, answer["text"])
+    INBOUND_LIMITER.metrics["coalesced"] += 1
+    return True
+
+
+def week_finished(u):
+    """Ответил ли участник на последний день (для записей без флага completed).
+
+    В старых записях ответы — строки без номера дня: неделю считаем пройденной,
+    если участник на последнем дне и ответы есть хотя бы за 7 дат.
+    """
+    if u.get("day", 1) < 7:
+        return False
+    responses = u.get("responses", {})
+    for items in responses.values():
+        for answer in [items] if isinstance(items, str) else items:
+            if isinstance(answer, dict) and answer.get("day") == 7:
+                return True
+    return len(responses) >= 7
 
 
 def today_date_str():
     return now_in_tz().date().isoformat()
 
 
+@bind_study
 async def send_reminder(context: ContextTypes.DEFAULT_TYPE):
     """Отправляет напоминание пользователю"""
     job = context.job
     chat_id = job.chat_id
     uid = str(chat_id)
 
-    logger.info(f"Отправка напоминания для пользователя {chat_id}")
-
-    global USER_DATA
-    USER_DATA = load_data()
+    logger.debug("Отправка напоминания для пользователя %s", chat_id)
 
-    u = USER_DATA.get(uid)
+    # Только чтение: get() вернул бы завершившего участника из архива обратно в хранилище
+    u = USER_DATA.peek(uid)
     if not u:
-        logger.error(f"Пользователь {chat_id} не найден")
+        logger.error("Пользователь %s не найден", chat_id)
+        return
+    if u.get("inactive") or u.get("completed"):
         return
 
     today = today_date_str()
     if u.get("answered_today") and u.get("last_response_date") == today:
-        logger.info(f"Пользователь {chat_id} уже ответил, удаляем напоминание")
+        logger.debug("Пользователь %s уже ответил, удаляем напоминание", chat_id)
         current_jobs = context.job_queue.get_jobs_by_name(f"reminder_{chat_id}")
         for job in current_jobs:
             job.schedule_removal()
@@ -115,8 +356,10 @@ async def send_reminder(context: ContextTypes.DEFAULT_TYPE):
             chat_id=chat_id,
             text=REMINDER_TEXT,
             parse_mode="HTML",
+            rate_limit_args={"lane": "reminder"},
         )
-        logger.info(f"Напоминание отправлено пользователю {chat_id}")
+        logger.debug("Напоминание отправлено пользователю %s", chat_id)
+        record_delivery(uid, u.get("day", 1), reminder=True)
 
         context.job_queue.run_once(
             send_reminder,
@@ -126,7 +369,7 @@ async def send_reminder(context: ContextTypes.DEFAULT_TYPE):
         )
 
     except Exception as e:
-        logger.error(f"Ошибка при отправке напоминания пользователю {chat_id}: {e}")
+        handle_delivery_error(context, chat_id, e, "напоминание")
 
 
 def schedule_reminders(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
@@ -141,7 +384,7 @@ def schedule_reminders(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
         chat_id=chat_id,
         name=f"reminder_{chat_id}"
     )
-    logger.info(f"Запланировано напоминание для {chat_id} через 1 час")
+    logger.debug("Запланировано напоминание для %s через %d с", chat_id, REMINDER_INTERVAL)
 
 
 def cancel_reminders(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
@@ -149,64 +392,65 @@ def cancel_reminders(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
     current_jobs = context.job_queue.get_jobs_by_name(f"reminder_{chat_id}")
     for job in current_jobs:
         job.schedule_removal()
-    logger.info(f"Напоминания отменены для пользователя {chat_id}")
+    logger.debug("Напоминания отменены для пользователя %s", chat_id)
 
 
+def cancel_jobs(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
+    """Снимает напоминания и отправку следующего дня"""
+    for name in (f"reminder_{chat_id}", f"nextday_{chat_id}"):
+        for job in context.job_queue.get_jobs_by_name(name):
+            job.schedule_removal()
+
+
+@bind_study
 async def send_day_message(context: ContextTypes.DEFAULT_TYPE):
     """Отправляет сообщение следующего дня"""
     job = context.job
     chat_id = job.chat_id
     uid = str(chat_id)
 
-    logger.info(f"Отправка сообщения дня для пользователя {chat_id}")
-
-    global USER_DATA
-    USER_DATA = load_data()
+    logger.debug("Отправка сообщения дня для пользователя %s", chat_id)
 
-    u = USER_DATA.get(uid)
+    u = USER_DATA.peek(uid)
     if not u:
-        logger.error(f"Пользователь {chat_id} не найден")
+        logger.error("Пользователь %s не найден", chat_id)
+        return
+    if u.get("inactive") or u.get("completed"):
         return
+    u = USER_DATA.get(uid)
 
     day = u.get("day", 1)
 
     u["answered_today"] = False
     u["care_question_answered"] = False
     u["waiting_for_care_response"] = False
-    save_data(USER_DATA)
+    save_user(uid, u)
 
     try:
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text=DAY_GREETING_TEXT.format(day=day),
-            parse_mode="HTML"
-        )
-
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text=CARE_QUESTION_TEXT,
-            reply_markup=YES_NO_KEYBOARD,
-            parse_mode="HTML"
-        )
+        await compose.send_composed(context.bot, chat_id, [
+            compose.part(SCRIPT.DAY_GREETING_TEXT.format(day=day), "HTML"),
+            compose.part(SCRIPT.CARE_QUESTION_TEXT, "HTML", YES_NO_KEYBOARD),
+        ], rate_limit_args={"lane": "day_message"})
 
+        record_delivery(uid, day)
         schedule_reminders(context, chat_id)
 
-        logger.info(f"Сообщение дня {day} отправлено пользователю {chat_id}")
+        logger.debug("Сообщение дня %s отправлено пользователю %s", day, chat_id)
 
     except Exception as e:
-        logger.error(f"Ошибка при отправке сообщения пользователю {chat_id}: {e}")
+        handle_delivery_error(context, chat_id, e, "сообщение дня")
 
 
 def schedule_next_day(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
     """Планирует отправку следующего дня на следующий день после последнего ответа"""
-    global USER_DATA
-    USER_DATA = load_data()
 
     uid = str(chat_id)
     u = USER_DATA.get(uid)
 
     if not u or not u.get("next_day_time"):
-        logger.warning(f"Нет времени для планирования у пользователя {chat_id}")
+        logger.warning("Нет времени для планирования у пользователя %s", chat_id)
+        return
+    if u.get("inactive"):
         return
 
     try:
@@ -227,9 +471,9 @@ def schedule_next_day(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
 
         if delay < 0:
             delay = 10
-            logger.info(f"Время уже прошло, отправляем через {delay} секунд")
+            logger.debug("Время для %s уже прошло, отправляем через %s секунд", chat_id, delay)
 
-        logger.info(f"Планируем отправку для {chat_id} на {send_time} (через {delay:.0f} секунд)")
+        logger.debug("Планируем отправку для %s на %s (через %.0f секунд)", chat_id, send_time, delay)
 
         current_jobs = context.job_queue.get_jobs_by_name(f"nextday_{chat_id}")
         for job in current_jobs:
@@ -241,58 +485,87 @@ def schedule_next_day(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
             chat_id=chat_id,
             name=f"nextday_{chat_id}"
         )
-        logger.info(f"Создано задание для {chat_id} на время {send_time}")
-
     except Exception as e:
-        logger.error(f"Ошибка планирования для {chat_id}: {e}")
+        logger.error("Ошибка планирования для %s: %s", chat_id, e)
 
 
-async def check_missed_day(context: ContextTypes.DEFAULT_TYPE):
+async def check_missed_day(context: ContextTypes.DEFAULT_TYPE, batch_size=500):
     """Проверяет пользователей, которые не ответили за предыдущий день, и отправляет сообщение 'нам очень жаль'"""
-    logger.info("=== ПРОВЕРКА ПРОПУЩЕННЫХ ДНЕЙ ===")
-
-    global USER_DATA
-    USER_DATA = load_data()
+    log = BulkLog(logger, "Проверка пропущенных дней")
 
     today = today_date_str()
     yesterday = (now_in_tz().date() - timedelta(days=1)).isoformat()
 
-    processed_count = 0
-
-    for uid, u in USER_DATA.items():
+    # По одному участнику с диска: записи всех участников разом в памяти не держим
+    for i, (uid, u) in enumerate(USER_DATA.iter_records()):
+        if i % batch_size == batch_size - 1:
+            await asyncio.sleep(0)
         try:
             chat_id = int(uid)
         except Exception:
             continue
 
+        if not u.get("completed") and week_finished(u):
+            # Неделя пройдена до появления флага completed — проставляем его задним числом
+            u = USER_DATA.get(uid)
+            u["completed"] = True
+            u["completed_date"] = u.get("last_response_date") or today
+            save_user(uid, u)
+            cancel_jobs(context, chat_id)
+            log.event("backfilled", "Участнику %s проставлено завершение недели", uid)
+
+        if u.get("completed"):
+            # Неделя завершена — переносим в архив, в ночные проверки он больше не попадёт
+            if USER_DATA.archive_participant(uid, today):
+                log.event("archived", "Участник %s перенесён в архив", uid)
+            continue
+
+        if u.get("inactive"):
+            log.event("inactive")
+            continue
+
         last_response_date = u.get("last_response_date")
         answered_today = u.get("answered_today", False)
 
         if last_response_date != yesterday and not answered_today:
+            # Берём запись через кэш, чтобы изменения попали в хранилище
+            u = USER_DATA.get(uid)
+            if u.get("day", 1) >= 7:
+                # Последний день пропущен — следующего нет, извиняться не за что: неделя окончена,
+                # следующая проверка перенесёт участника в архив
+                u["completed"] = True
+                u["completed_date"] = today
+                u["missed_final_day"] = True
+                save_user(uid, u)
+                cancel_jobs(context, chat_id)
+                log.event("completed_missed", "Участник %s пропустил последний день, неделя завершена", uid)
+                continue
             try:
                 await context.bot.send_message(
                     chat_id=chat_id,
-                    text=SORRY_TEXT,
-                    parse_mode="HTML"
+                    text=SCRIPT.SORRY_TEXT,
+                    parse_mode="HTML",
+                    rate_limit_args={"lane": "apology"},
                 )
-                logger.info(f"Отправлено сообщение 'нам очень жаль' пользователю {chat_id}")
-
                 current_day = u.get("day", 1)
-                if current_day < 7:
-                    u["day"] = current_day + 1
-                    logger.info(f"День пользователя {chat_id} обновлен с {current_day} на {u['day']}")
+                u["day"] = current_day + 1
 
                 u["answered_today"] = False
                 u["care_question_answered"] = False
                 u["waiting_for_care_response"] = False
 
-                save_data(USER_DATA)
-                processed_count += 1
+                save_user(uid, u)
+                log.event("apology", "Пользователю %s отправлено 'нам очень жаль', день %s -> %s",
+                          chat_id, current_day, u["day"])
 
             except Exception as e:
-                logger.error(f"Ошибка при обработке пропущенного дня для {chat_id}: {e}")
+                kind = classify_error(e)
+                if kind in PERMANENT_ERRORS:
+                    deactivate(context, chat_id, kind, log)
+                else:
+                    log.error(f"failed_{kind}", "Ошибка при обработке пропущенного дня для %s: %s", chat_id, e)
 
-    logger.info(f"=== ОБРАБОТАНО {processed_count} ПОЛЬЗОВАТЕЛЕЙ С ПРОПУЩЕННЫМИ ДНЯМИ ===")
+    log.summary()
 
 
 def schedule_daily_check(context: ContextTypes.DEFAULT_TYPE):
@@ -305,7 +578,7 @@ def schedule_daily_check(context: ContextTypes.DEFAULT_TYPE):
 
     delay = (check_time - now).total_seconds()
 
-    logger.info(f"Планируем ежедневную проверку на {check_time} (через {delay:.0f} секунд)")
+    logger.info("Планируем ежедневную проверку на %s (через %.0f секунд)", check_time, delay)
 
     current_jobs = context.job_queue.get_jobs_by_name("daily_check")
     for job in current_jobs:
@@ -318,6 +591,7 @@ def schedule_daily_check(context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+@bind_study
 async def schedule_daily_check_callback(context: ContextTypes.DEFAULT_TYPE):
     """Колбэк для планирования ежедневной проверки"""
     await check_missed_day(context)
@@ -339,6 +613,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "care_question_answered": False,
             "waiting_for_care_response": False,
             "last_response_date": None,
+            "started_date": today_date_str(),
             "responses": {},
             "next_day_time": None,
             "user_info": {
@@ -348,14 +623,16 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             }
         }
         u = USER_DATA[uid]
-        save_data(USER_DATA)
+        save_user(uid, u)
     else:
         u["user_info"] = {
             "first_name": user.first_name,
             "username": user.username,
             "user_id": user.id
         }
-        save_data(USER_DATA)
+        if reactivate(u):
+            logger.info("Участник %s вернулся, снова активен", chat_id)
+        save_user(uid, u)
 
     today = today_date_str()
     day = u.get("day", 1)
@@ -365,17 +642,14 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"Ты уже ответил(а) на сегодняшний вопрос! Сегодня у нас был день {day - 1}. Жду тебя завтра для следующего задания. 🙂"
         )
     else:
+        parts = []
         if u.get("last_response_date") is None:
-            await update.message.reply_text(WELCOME_TEXT, parse_mode="HTML")
-
-        await update.message.reply_text(DAY_GREETING_TEXT.format(day=day), parse_mode="HTML")
-
-        await update.message.reply_text(
-            CARE_QUESTION_TEXT,
-            reply_markup=YES_NO_KEYBOARD,
-            parse_mode="HTML"
-        )
+            parts.append(compose.part(SCRIPT.WELCOME_TEXT, "HTML"))
+        parts.append(compose.part(SCRIPT.DAY_GREETING_TEXT.format(day=day), "HTML"))
+        parts.append(compose.part(SCRIPT.CARE_QUESTION_TEXT, "HTML", YES_NO_KEYBOARD))
+        await compose.send_composed(context.bot, chat_id, parts)
 
+        record_delivery(uid, day)
         schedule_reminders(context, chat_id)
 
 
@@ -384,8 +658,6 @@ async def handle_care_question(update: Update, context: ContextTypes.DEFAULT_TYP
     uid = str(chat_id)
     text = update.message.text.strip().lower()
 
-    global USER_DATA
-    USER_DATA = load_data()
     u = USER_DATA.get(uid)
 
     if not u:
@@ -393,34 +665,26 @@ async def handle_care_question(update: Update, context: ContextTypes.DEFAULT_TYP
 
     if text == "да":
         await update.message.reply_text(
-            CARE_TIPS_TEXT,
+            SCRIPT.CARE_TIPS_TEXT,
             reply_markup=ReplyKeyboardRemove(),
             parse_mode="HTML"
         )
         u["waiting_for_care_response"] = True
         u["care_question_answered"] = True
-        save_data(USER_DATA)
+        save_user(uid, u)
 
     else:
-        await update.message.reply_text(
-            "Хорошо!",
-            reply_markup=ReplyKeyboardRemove(),
-            parse_mode="HTML"
-        )
         u["care_question_answered"] = True
-        save_data(USER_DATA)
+        save_user(uid, u)
 
         day = u.get("day", 1)
-        await update.message.reply_text(
-            DAY_TEXTS.get(day, "Спасибо! Неделя завершена. 🎉"),
-            parse_mode="HTML"
-        )
-
+        parts = [
+            compose.part("Хорошо!", "HTML", ReplyKeyboardRemove()),
+            compose.part(SCRIPT.DAY_TEXTS.get(day, "Спасибо! Неделя завершена. 🎉"), "HTML"),
+        ]
         if day < 7:
-            await update.message.reply_text(
-                "После ответа отправь время для следующего дня в формате ЧЧ:ММ (например, 09:30)",
-                parse_mode="HTML"
-            )
+            parts.append(compose.part("После ответа отправь время для следующего дня в формате ЧЧ:ММ (например, 09:30)", "HTML"))
+        await compose.send_composed(context.bot, chat_id, parts)
 
 
 async def handle_media_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -454,37 +718,38 @@ async def process_user_response(update: Update, context: ContextTypes.DEFAULT_TY
 
     u = USER_DATA.get(uid)
 
+    if u and answer_seen(u, update.message, today_date_str()):
+        logger.info("Сообщение %s от %s уже сохранено, повтор пропущен", update.message.message_id, chat_id)
+        return
+
     if u and not u.get("care_question_answered", False):
         await handle_care_question(update, context)
         return
 
     if u and u.get("waiting_for_care_response", False):
-        saved_text = update.message.text or update.message.caption or "<медиа-сообщение>"
+        answer = make_answer(update.message, u.get("day", 1))
 
         today = today_date_str()
         if "care_responses" not in u:
             u["care_responses"] = {}
 
         day_care_responses = u["care_responses"].get(today, [])
-        day_care_responses.append(saved_text)
+        day_care_responses.append(answer)
         u["care_responses"][today] = day_care_responses
 
         u["waiting_for_care_response"] = False
-        save_data(USER_DATA)
-
-        await update.message.reply_text(NEXT_TO_QUESTIONS_TEXT, parse_mode="HTML")
+        save_user(uid, u)
+        if answer["text"]:
+            SEARCH_INDEX.add(uid, "care", today, answer["day"], len(day_care_responses) - 1, answer["text"])
 
         day = u.get("day", 1)
-        await update.message.reply_text(
-            DAY_TEXTS.get(day, "Спасибо! Неделя завершена. 🎉"),
-            parse_mode="HTML"  # ← ДОБАВИТЬ ЭТУ СТРОЧКУ
-        )
-
+        parts = [
+            compose.part(SCRIPT.NEXT_TO_QUESTIONS_TEXT, "HTML"),
+            compose.part(SCRIPT.DAY_TEXTS.get(day, "Спасибо! Неделя завершена. 🎉"), "HTML"),
+        ]
         if day < 7:
-            await update.message.reply_text(
-                "После ответа отправь время для следующего дня в формате ЧЧ:ММ (например, 09:30)",
-                parse_mode="HTML"
-            )
+            parts.append(compose.part("После ответа отправь время для следующего дня в формате ЧЧ:ММ (например, 09:30)", "HTML"))
+        await compose.send_composed(context.bot, chat_id, parts)
         return
 
     if u is None:
@@ -494,6 +759,7 @@ async def process_user_response(update: Update, context: ContextTypes.DEFAULT_TY
             "care_question_answered": False,
             "waiting_for_care_response": False,
             "last_response_date": None,
+            "started_date": today_date_str(),
             "responses": {},
             "next_day_time": None,
             "user_info": {
@@ -509,34 +775,39 @@ async def process_user_response(update: Update, context: ContextTypes.DEFAULT_TY
             "username": user.username,
             "user_id": user.id
         }
+        reactivate(u)
 
     today = today_date_str()
 
     if u.get("answered_today") and u.get("last_response_date") == today:
+        if coalesce_answer(uid, u, update.message, today):
+            return
         await update.message.reply_text(
             f"Ты уже ответил(а) на сегодняшний вопрос. Сегодня у нас день {u['day'] - 1}. Жду тебя завтра для следующего задания. 🙂",
             parse_mode="HTML",
         )
         return
 
-    saved_text = update.message.text or update.message.caption or "<медиа-сообщение>"
-
     # --- Создаем папку для пользователя ---
-    user_dir = os.path.join(MEDIA_DIR, uid)
+    user_dir = os.path.join(STUDY.media_dir, uid)
     os.makedirs(user_dir, exist_ok=True)
 
     # --- Сохранение медиа ---
+    media = None
     if update.message.photo:
         file = await context.bot.get_file(update.message.photo[-1].file_id)
-        file_path = os.path.join(user_dir, f"{today}_photo_{datetime.now().strftime('%H%M%S')}.jpg")
+        file_path = os.path.join(user_dir, f"{today}_photo_{now_in_tz().strftime('%H%M%S')}.jpg")
         await file.download_to_drive(file_path)
-        saved_text += f" [прикреплено фото: {file_path}]"
+        media = media_ref(update.message, file_path)
 
     elif update.message.video:
         file = await context.bot.get_file(update.message.video.file_id)
-        file_path = os.path.join(user_dir, f"{today}_video_{datetime.now().strftime('%H%M%S')}.mp4")
+        file_path = os.path.join(user_dir, f"{today}_video_{now_in_tz().strftime('%H%M%S')}.mp4")
         await file.download_to_drive(file_path)
-        saved_text += f" [прикреплено видео: {file_path}]"
+        media = media_ref(update.message, file_path)
+
+    current_day = u.get("day", 1)
+    answer = make_answer(update.message, current_day, media)
 
     # --- Сохраняем ответ в JSON ---
     if "responses" not in u:
@@ -546,17 +817,21 @@ async def process_user_response(update: Update, context: ContextTypes.DEFAULT_TY
     if isinstance(day_responses, str):
         day_responses = [day_responses]
 
-    day_responses.append(saved_text)
+    day_responses.append(answer)
     u["responses"][today] = day_responses
 
     u["answered_today"] = True
     u["last_response_date"] = today
 
-    current_day = u.get("day", 1)
     if current_day < 7:
         u["day"] = current_day + 1
+    else:
+        u["completed"] = True
+        u["completed_date"] = today
 
-    save_data(USER_DATA)
+    save_user(uid, u)
+    if answer["text"]:
+        SEARCH_INDEX.add(uid, "diary", today, current_day, len(day_responses) - 1, answer["text"])
 
     cancel_reminders(context, chat_id)
 
@@ -566,20 +841,16 @@ async def process_user_response(update: Update, context: ContextTypes.DEFAULT_TY
             parse_mode="HTML"
         )
     else:
+        await compose.send_composed(context.bot, chat_id, [
+            compose.part("Спасибо! ✅ Твоя заметка сохранена. Неделя исследований завершена! 🎉", "HTML"),
+            compose.part(SCRIPT.THANK_YOU_TEXT, "HTML"),
+        ])
 
-        await update.message.reply_text(
-            "Спасибо! ✅ Твоя заметка сохранена. Неделя исследований завершена! 🎉",
-            parse_mode="HTML"
-        )
-
-        await update.message.reply_text(
-            THANK_YOU_TEXT,
-            parse_mode="HTML"
-        )
+        # Завершившие неделю больше не пишут — не держим их в кэше
+        USER_DATA.release(uid)
 
 
 async def handle_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global USER_DATA
     chat_id = update.effective_chat.id
     uid = str(chat_id)
     u = USER_DATA.get(uid)
@@ -597,9 +868,9 @@ async def handle_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     u["next_day_time"] = f"{hour:02d}:{minute:02d}"
-    save_data(USER_DATA)
+    save_user(uid, u)
 
-    logger.info(f"Пользователь {chat_id} установил время: {u['next_day_time']}")
+    logger.debug("Пользователь %s установил время: %s", chat_id, u['next_day_time'])
 
     await update.message.reply_text(
         f"Отлично! ✅ Я отправлю следующий день в {u['next_day_time']} по твоему времени."
@@ -608,57 +879,167 @@ async def handle_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
     schedule_next_day(context, chat_id)
 
 ## ADMIN PANEL
+def collect_stats(payload, snapshot):
+    """Счётчики для /stats по участникам этого процесса (шарда)"""
+    counts = {"total_users": 0, "active_today": 0, "completed": 0, "archived": snapshot.archived,
+              "inactive": 0, "total_responses": 0}
+    today = today_date_str()
+    for uid, user_data in snapshot.iter_all():
+        counts["total_users"] += 1
+        if user_data.get("last_response_date") == today:
+            counts["active_today"] += 1
+        if user_data.get("completed"):
+            counts["completed"] += 1
+        if user_data.get("inactive"):
+            counts["inactive"] += 1
+        counts["total_responses"] += len(user_data.get("responses", {}))
+    return counts
+
+
+def collect_export(payload, snapshot):
+    """Все участники этого шарда, включая архив"""
+    return snapshot.to_dict(include_archive=True)
+
+
+def collect_user_info(payload, snapshot):
+    """user_info для тех uid из payload, которые принадлежат этому шарду"""
+    found = {}
+    for uid in payload or []:
+        user_data = snapshot.peek(uid)
+        if user_data is not None:
+            found[uid] = user_data.get("user_info", {})
+    return found
+
+
+def collect_search(payload, snapshot=None):
+    """Лучшие совпадения поиска по ответам участников этого шарда"""
+    return SEARCH_INDEX.search(
+        payload["query"],
+        day=payload.get("day"),
+        date_from=payload.get("date_from"),
+        date_to=payload.get("date_to"),
+        limit=payload.get("limit", 10),
+    )
+
+
+def collect_answer_rows(payload, snapshot):
+    """Плоские строки ответов и отправок для /report"""
+    from analytics import collect_rows
+    return collect_rows(snapshot.iter_all(), today_date_str())
+
+
+def collect_media_catalogue(payload, snapshot):
+    """Медиафайлы участников этого шарда по фильтрам /export_media"""
+    from media_export import catalogue
+    return catalogue(
+        snapshot.iter_all(),
+        today_date_str(),
+        uids=set(payload.get("uids") or []),
+        day=payload.get("day"),
+        date_from=payload.get("date_from"),
+        date_to=payload.get("date_to"),
+        cohort=payload.get("cohort"),
+    )
+
+
+ADMIN_COLLECTORS = {
+    "stats": collect_stats,
+    "export": collect_export,
+    "user_info": collect_user_info,
+    "search": collect_search,
+    "answer_rows": collect_answer_rows,
+    "media_catalogue": collect_media_catalogue,
+}
+# Поиск идёт по SQLite-индексу, а не по участникам: снимок ему не нужен
+INDEX_COLLECTORS = {"search"}
+
+
+async def run_collector(kind, payload=None):
+    """Коллектор этого процесса: {"result": ..., "taken_at": время среза}.
+
+    Снимок участников берётся в цикле событий (это быстро), а обход снимка
+    идёт в потоке — обработчики тем временем продолжают менять участников.
+    """
+    collector = ADMIN_COLLECTORS[kind]
+    if kind in INDEX_COLLECTORS:
+        return {"result": collector(payload), "taken_at": time.time()}
+    with USER_DATA.snapshot() as snapshot:
+        result = await asyncio.to_thread(collector, payload, snapshot)
+    return {"result": result, "taken_at": snapshot.taken_at}
+
+
+async def gather_admin(kind, payload=None):
+    """Результаты коллектора со всех шардов (в обычном режиме — только локальный) и время самого старого среза"""
+    if SHARD_COUNT <= 1:
+        parts = [await run_collector(kind, payload)]
+    else:
+        from shard import gather
+        parts = await gather(kind, payload, SHARD_PEERS, SHARD_INDEX, functools.partial(run_collector, kind))
+    return [part["result"] for part in parts], min(part["taken_at"] for part in parts)
+
+
+def snapshot_note(taken_at):
+    """Строка о возрасте среза данных для ответов админу"""
+    taken = datetime.fromtimestamp(taken_at, TZ)
+    return f"🕒 Срез данных: {taken:%d.%m %H:%M:%S} ({max(0.0, time.time() - taken_at):.0f} с назад)"
+
+
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Статистика бота (доступна всем)"""
-    chat_id = update.effective_chat.id
-
-    global USER_DATA
-    USER_DATA = load_data()
+    # Команда открыта всем — обход всех участников делаем не чаще раза в STATS_CACHE_TTL
+    if STATS_CACHE["text"] and time.monotonic() - STATS_CACHE["at"] < STATS_CACHE_TTL:
+        await update.message.reply_text(STATS_CACHE["text"] + snapshot_note(STATS_CACHE["taken_at"]), parse_mode="HTML")
+        return
 
-    total_users = len(USER_DATA)
-    active_today = 0
-    total_responses = 0
+    parts, taken_at = await gather_admin("stats")
+    totals = {}
+    for counts in parts:
+        for key, value in counts.items():
+            totals[key] = totals.get(key, 0) + value
 
     today = today_date_str()
-    for uid, user_data in USER_DATA.items():
-        if user_data.get("last_response_date") == today:
-            active_today += 1
-        total_responses += len(user_data.get("responses", {}))
-
     stats_text = f"""
 📊 <b>Статистика бота</b>
 
-👥 Всего пользователей: {total_users}
-✅ Активных сегодня: {active_today}
-💬 Всего ответов: {total_responses}
+👥 Всего пользователей: {totals['total_users']}
+✅ Активных сегодня: {totals['active_today']}
+🎉 Завершили исследование: {totals['completed']} (в архиве: {totals['archived']})
+🚫 Недоступны (заблокировали бота): {totals['inactive']}
+💬 Всего ответов: {totals['total_responses']}
 
 📅 Данные обновлены: {today}
 """
-    await update.message.reply_text(stats_text, parse_mode="HTML")
+    STATS_CACHE["text"] = stats_text
+    STATS_CACHE["at"] = time.monotonic()
+    STATS_CACHE["taken_at"] = taken_at
+    await update.message.reply_text(stats_text + snapshot_note(taken_at), parse_mode="HTML")
+
 
 async def export_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Экспорт данных (только для админа)"""
-    if not ADMIN_ID:
+    if not STUDY.admin_id:
         await update.message.reply_text("❌ Admin commands are disabled")
         return
 
-    if update.effective_chat.id != ADMIN_ID:
+    if update.effective_chat.id != STUDY.admin_id:
         await update.message.reply_text("❌ Эта команда только для администратора")
         return
 
-    global USER_DATA
-    USER_DATA = load_data()
+    parts, taken_at = await gather_admin("export")
+    data = {}
+    for part in parts:
+        data.update(part)
 
     import tempfile
     with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False, encoding='utf-8') as f:
-        json.dump(USER_DATA, f, ensure_ascii=False, indent=2)
+        json.dump(data, f, ensure_ascii=False, indent=2)
         temp_path = f.name
 
     with open(temp_path, 'rb') as f:
         await update.message.reply_document(
             document=f,
             filename=f"bot_data_{today_date_str()}.json",
-            caption="Данные бота"
+            caption=f"Данные бота\n{snapshot_note(taken_at)}"
         )
 
     os.unlink(temp_path)
@@ -669,24 +1050,24 @@ async def admin_check(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     chat_id = update.effective_chat.id
 
-    if not ADMIN_ID:
+    if not STUDY.admin_id:
         await update.message.reply_text("❌ Admin commands are disabled (ADMIN_ID not set)")
         return
 
-    if chat_id == ADMIN_ID:
+    if chat_id == STUDY.admin_id:
         await update.message.reply_text(f"✅ Вы администратор! Ваш ID: {chat_id}")
     else:
-        await update.message.reply_text(f"❌ Вы не администратор. Ваш ID: {chat_id}\nАдмин ID: {ADMIN_ID}")
+        await update.message.reply_text(f"❌ Вы не администратор. Ваш ID: {chat_id}\nАдмин ID: {STUDY.admin_id}")
 
 
 async def get_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Получить медиа файлы пользователя (только для админа)"""
 
-    if not ADMIN_ID:
+    if not STUDY.admin_id:
         await update.message.reply_text("❌ Admin commands are disabled")
         return
 
-    if update.effective_chat.id != ADMIN_ID:
+    if update.effective_chat.id != STUDY.admin_id:
         await update.message.reply_text("❌ Эта команда только для администратора")
         return
 
@@ -700,7 +1081,7 @@ async def get_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     try:
         user_id = context.args[0]
-        user_media_dir = os.path.join(MEDIA_DIR, user_id)
+        user_media_dir = os.path.join(STUDY.media_dir, user_id)
 
         if not os.path.exists(user_media_dir):
             await update.message.reply_text(f"❌ Папка пользователя {user_id} не найдена")
@@ -743,11 +1124,10 @@ async def get_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
                 sent_count += 1
 
-                import asyncio
                 await asyncio.sleep(1)
 
             except Exception as e:
-                logger.error(f"Ошибка отправки файла {media_file}: {e}")
+                logger.error("Ошибка отправки файла %s: %s", media_file, e)
                 await update.message.reply_text(f"❌ Ошибка отправки {media_file}")
 
         if len(media_files) > 10:
@@ -758,30 +1138,30 @@ async def get_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
 
     except Exception as e:
-        logger.error(f"Ошибка в get_media: {e}")
+        logger.error("Ошибка в get_media: %s", e)
         await update.message.reply_text("❌ Ошибка при получении медиа файлов")
 
 
 async def list_users_with_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Список всех пользователей у которых есть медиа файлы"""
 
-    if not ADMIN_ID:
+    if not STUDY.admin_id:
         await update.message.reply_text("❌ Admin commands are disabled")
         return
 
-    if update.effective_chat.id != ADMIN_ID:
+    if update.effective_chat.id != STUDY.admin_id:
         await update.message.reply_text("❌ Эта команда только для администратора")
         return
 
     try:
         users_with_media = []
 
-        if not os.path.exists(MEDIA_DIR):
+        if not os.path.exists(STUDY.media_dir):
             await update.message.reply_text("❌ Папка user_media не существует")
             return
 
-        for user_id in os.listdir(MEDIA_DIR):
-            user_dir = os.path.join(MEDIA_DIR, user_id)
+        for user_id in os.listdir(STUDY.media_dir):
+            user_dir = os.path.join(STUDY.media_dir, user_id)
             if os.path.isdir(user_dir):
                 media_files = [f for f in os.listdir(user_dir) if f.endswith(('.jpg', '.jpeg', '.png', '.mp4', '.mov'))]
                 if media_files:
@@ -791,14 +1171,15 @@ async def list_users_with_media(update: Update, context: ContextTypes.DEFAULT_TY
             await update.message.reply_text("❌ Нет пользователей с медиа файлами")
             return
 
-        global USER_DATA
-        USER_DATA = load_data()
+        parts, taken_at = await gather_admin("user_info", [user_id for user_id, _ in users_with_media])
+        infos = {}
+        for part in parts:
+            infos.update(part)
 
         message = "👥 <b>Пользователи с медиа файлами:</b>\n\n"
 
         for user_id, file_count in sorted(users_with_media, key=lambda x: x[1], reverse=True):
-            user_data = USER_DATA.get(user_id, {})
-            user_info = user_data.get("user_info", {})
+            user_info = infos.get(user_id, {})
             user_name = user_info.get('first_name', 'Unknown')
             username = user_info.get('username', 'No username')
 
@@ -807,22 +1188,359 @@ async def list_users_with_media(update: Update, context: ContextTypes.DEFAULT_TY
             message += f"   📁 Файлов: {file_count}\n"
             message += f"   📥 Команда: <code>/get_media {user_id}</code>\n\n"
 
+        message += snapshot_note(taken_at)
         await update.message.reply_text(message, parse_mode="HTML")
 
     except Exception as e:
-        logger.error(f"Ошибка в list_users_with_media: {e}")
+        logger.error("Ошибка в list_users_with_media: %s", e)
         await update.message.reply_text("❌ Ошибка при получении списка пользователей")
 
+
+def parse_search_args(args):
+    """/search <запрос> [день 1-7] [ГГГГ-ММ-ДД или ГГГГ-ММ-ДД..ГГГГ-ММ-ДД]"""
+    payload = {"day": None, "date_from": None, "date_to": None}
+    words = []
+    for arg in args:
+        if re.fullmatch(r"[1-7]", arg):
+            payload["day"] = int(arg)
+        elif re.fullmatch(r"\d{4}-\d{2}-\d{2}(\.\.\d{4}-\d{2}-\d{2})?", arg):
+            date_from, _, date_to = arg.partition("..")
+            payload["date_from"] = date_from
+            payload["date_to"] = date_to or date_from
+        else:
+            words.append(arg)
+    payload["query"] = " ".join(words)
+    return payload
+
+
+async def search_answers(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Полнотекстовый поиск по ответам (только для админа)"""
+    if not STUDY.admin_id:
+        await update.message.reply_text("❌ Admin commands are disabled")
+        return
+
+    if update.effective_chat.id != STUDY.admin_id:
+        await update.message.reply_text("❌ Эта команда только для администратора")
+        return
+
+    payload = parse_search_args(context.args)
+    if not payload["query"]:
+        await update.message.reply_text(
+            "Использование: /search <запрос> [день 1-7] [ГГГГ-ММ-ДД или ГГГГ-ММ-ДД..ГГГГ-ММ-ДД]\n"
+            "Например: /search химчистка 3 2026-01-01..2026-01-31"
+        )
+        return
+
+    started = time.perf_counter()
+    parts, _ = await gather_admin("search", payload)
+    results = []
+    for part in parts:
+        results.extend(part)
+    # bm25 в SQLite отрицательный: чем меньше, тем релевантнее
+    results.sort(key=lambda r: r["score"])
+    results = results[:10]
+    elapsed_ms = (time.perf_counter() - started) * 1000
+
+    if not results:
+        await update.message.reply_text(f"🔍 Ничего не найдено ({elapsed_ms:.0f} мс)")
+        return
+
+    message = f"🔍 <b>{html.escape(payload['query'])}</b> — {len(results)} лучших ({elapsed_ms:.0f} мс)\n\n"
+    for r in results:
+        kind = "уход" if r["kind"] == "care" else f"день {r['day']}"
+        message += f"👤 <code>{r['uid']}</code>, {r['date']}, {kind}\n{r['snippet']}\n\n"
+    await update.message.reply_text(message, parse_mode="HTML")
+
+
+async def export_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """ZIP-архив медиа с манифестом, частями до лимита Telegram (только для админа)"""
+    if not STUDY.admin_id:
+        await update.message.reply_text("❌ Admin commands are disabled")
+        return
+
+    if update.effective_chat.id != STUDY.admin_id:
+        await update.message.reply_text("❌ Эта команда только для администратора")
+        return
+
+    from media_export import iter_parts
+
+    # Те же фильтры, что у /search; слова запроса — ID участников или когорта (2026-W02)
+    payload = parse_search_args(context.args)
+    words = payload.pop("query").split()
+    payload["cohort"] = next((w for w in words if re.fullmatch(r"\d{4}-W\d{2}", w)), None)
+    payload["uids"] = [w for w in words if w.isdigit()]
+
+    catalogues, taken_at = await gather_admin("media_catalogue", payload)
+    entries = []
+    for part in catalogues:
+        entries.extend(part)
+    if not entries:
+        await update.message.reply_text(
+            "❌ Медиа по этим фильтрам не найдено\n"
+            "Использование: /export_media [ID участников] [2026-W02] [день 1-7] [ГГГГ-ММ-ДД или ГГГГ-ММ-ДД..ГГГГ-ММ-ДД]"
+        )
+        return
+
+    await update.message.reply_text(f"📦 Файлов: {len(entries)}, собираю архив...\n{snapshot_note(taken_at)}")
+
+    skipped = []
+    parts = iter_parts(entries, skipped=skipped)
+    number = 0
+    while True:
+        # Чтение файлов и сборка части — в отдельном потоке, чтобы не задерживать остальные апдейты
+        part = await asyncio.to_thread(next, parts, None)
+        if part is None:
+            break
+        data, rows = part
+        number += 1
+        await update.message.reply_document(
+            document=data,
+            filename=f"media_{today_date_str()}_part{number}.zip",
+            caption=f"Часть {number}: {len(rows)} файлов",
+        )
+
+    message = f"✅ Отправлено частей: {number}"
+    if skipped:
+        message += f"\nПропущено файлов: {len(skipped)}"
+        for entry in skipped[:10]:
+            message += f"\n{entry['uid']} {entry['date']}: {os.path.basename(entry['path'])} — {entry['reason']}"
+    await update.message.reply_text(message)
+
+
+async def report(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отчёт по вовлечённости: воронка, задержки ответов, напоминания (только для админа)"""
+    if not STUDY.admin_id:
+        await update.message.reply_text("❌ Admin commands are disabled")
+        return
+
+    if update.effective_chat.id != STUDY.admin_id:
+        await update.message.reply_text("❌ Эта команда только для администратора")
+        return
+
+    try:
+        import analytics
+    except ImportError as e:
+        await update.message.reply_text(f"❌ Для отчёта нужны numpy и pandas: {e}")
+        return
+
+    parts, taken_at = await gather_admin("answer_rows")
+    rows = analytics.merge_rows(parts)
+    # Подсчёт на pandas — в отдельном потоке, чтобы не задерживать остальные апдейты
+    result = await asyncio.to_thread(analytics.build_report, rows, REMINDER_INTERVAL)
+    await update.message.reply_text(analytics.format_report(result) + "\n" + snapshot_note(taken_at), parse_mode="HTML")
+
+
+async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """cProfile + tracemalloc на заданное число секунд, отчёт документом (только для админа)"""
+    if not STUDY.admin_id:
+        await update.message.reply_text("❌ Admin commands are disabled")
+        return
+
+    if update.effective_chat.id != STUDY.admin_id:
+        await update.message.reply_text("❌ Эта команда только для администратора")
+        return
+
+    from profiling import ProfileSession
+
+    try:
+        seconds = int(context.args[0]) if context.args else 30
+    except ValueError:
+        seconds = 0
+    if not 1 <= seconds <= PROFILE_MAX_SECONDS:
+        await update.message.reply_text(f"Использование: /profile <секунды от 1 до {PROFILE_MAX_SECONDS}>")
+        return
+
+    session = ProfileSession()
+    try:
+        session.start()
+    except RuntimeError as e:
+        await update.message.reply_text(f"❌ {e}")
+        return
+    await update.message.reply_text(f"⏱ Профилирую {seconds} с...")
+
+    async def finish():
+        # Обработчик не ждёт окна целиком, иначе остальные апдейты встали бы в очередь
+        await asyncio.sleep(seconds)
+        report_text = session.report()
+        await context.bot.send_document(
+            chat_id=update.effective_chat.id,
+            document=report_text.encode("utf-8"),
+            filename=f"profile_{now_in_tz().strftime('%Y%m%d_%H%M%S')}.txt",
+            caption=f"Профиль за {seconds} с",
+        )
+
+    context.application.create_task(finish(), update=update)
+
+
+async def restore_schedules(application, batch_size=500):
+    """Восстанавливает задания next_day и напоминания для всех участников"""
+    log = BulkLog(logger, "Восстановление расписания")
+    today = today_date_str()
+    for i, (uid, u) in enumerate(USER_DATA.iter_records()):
+        try:
+            chat_id = int(uid)
+        except Exception:
+            continue
+
+        if u.get("completed"):
+            continue
+        if u.get("inactive"):
+            log.event("inactive")
+            continue
+
+        if u.get("next_day_time"):
+            schedule_next_day(application, chat_id)
+            log.event("next_day", "Восстановлено для %s: время %s, день %s", chat_id, u["next_day_time"], u.get("day", 1))
+
+        if not u.get("answered_today") or u.get("last_response_date") != today:
+            schedule_reminders(application, chat_id)
+            log.event("reminders")
+
+        if i % batch_size == batch_size - 1:
+            await asyncio.sleep(0)
+
+    log.summary()
+
+
+async def flush_periodically(studies):
+    """Периодически сбрасывает изменённых участников на диск (одна задача на все исследования процесса)"""
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        for study in studies:
+            study.flush()
+
+
+async def hydrate_and_restore(application):
+    """Фоновая загрузка участников и восстановление расписания"""
+    try:
+        warmed = await USER_DATA.warm(skip=lambda u: u.get("completed"))
+        STARTUP_TIMER.phase(f"загрузка участников в кэш ({warmed})")
+        await restore_schedules(application)
+        STARTUP_TIMER.phase("восстановление расписания")
+        if len(SEARCH_INDEX) == 0:
+            indexed = await SEARCH_INDEX.rebuild(USER_DATA.iter_all())
+            STARTUP_TIMER.phase(f"построение поискового индекса ({indexed})")
+    except Exception as e:
+        logger.exception("Ошибка при фоновой загрузке участников: %s", e)
+
+
+async def cache_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Метрики кэша участников (только для админа)"""
+    if not STUDY.admin_id:
+        await update.message.reply_text("❌ Admin commands are disabled")
+        return
+
+    if update.effective_chat.id != STUDY.admin_id:
+        await update.message.reply_text("❌ Эта команда только для администратора")
+        return
+
+    m = USER_DATA.metrics()
+    j = STUDY.journal.metrics
+    await update.message.reply_text(
+        "🗄 <b>Кэш участников</b>\n\n"
+        f"В памяти: {m['cached']} из {USER_DATA.max_cached}\n"
+        f"Не записано на диск: {m['dirty']}\n"
+        f"Попадания: {m['hits']} / промахи: {m['misses']} ({m['hit_rate'] * 100:.1f}%)\n"
+        f"Вытеснено: {m['evictions']}, по TTL: {m['expired']}, с записью: {m['writebacks']}\n"
+        f"Журнал: записей {j['committed']}, повторов отброшено {j['duplicates']}, "
+        f"контрольных точек {j['checkpoints']}, восстановлено при запуске {j['replayed']}",
+        parse_mode="HTML"
+    )
+
+
+async def queue_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Очереди исходящих сообщений по приоритетам (только для админа)"""
+    if not STUDY.admin_id:
+        await update.message.reply_text("❌ Admin commands are disabled")
+        return
+
+    if update.effective_chat.id != STUDY.admin_id:
+        await update.message.reply_text("❌ Эта команда только для администратора")
+        return
+
+    message = "📤 <b>Исходящие сообщения</b>\n\n"
+    for lane, m in context.bot.rate_limiter.report().items():
+        message += (
+            f"<b>{lane}</b>: в очереди {m['depth']} (макс. {m['max_depth']}), "
+            f"отправлено {m['sent']}, ошибок {m['failed']}, "
+            f"ожидание {m['avg_wait_ms']} мс (макс. {m['max_wait_ms']} мс)\n"
+        )
+        if m["success_rate"] is not None:
+            errors = ", ".join(f"{kind} {count}" for kind, count in sorted(m["errors"].items()))
+            message += f"    доставлено {m['success_rate'] * 100:.1f}%" + (f" (ошибки: {errors})" if errors else "") + "\n"
+
+    m = compose.METRICS
+    if m["parts"]:
+        message += (
+            f"Склейка сообщений: {m['parts']} частей ушло {m['sends']} запросами "
+            f"(сэкономлено {m['parts'] - m['sends']})\n"
+        )
+
+    m = INBOUND_LIMITER.metrics
+    message += (
+        "\n📥 <b>Входящие апдейты</b>\n"
+        f"Обработано: {m['passed']}, отброшено: {m['dropped_chat']} (лимит чата), "
+        f"{m['dropped_global']} (общий лимит)\n"
+        f"Пропущено сверх лимита чата для склейки: {m['overflow_passed']}\n"
+        f"Склеено с предыдущим ответом: {m['coalesced']}\n"
+    )
+    await update.message.reply_text(message, parse_mode="HTML")
+
+
 # --- Main ---
-def main():
-    application = ApplicationBuilder().token(TOKEN).build()
+def build_application(request=None, get_updates_request=None, clock=None, study=None, rate_limiter=None,
+                      job_queue=None):
+    """Собирает приложение со всеми обработчиками (без запуска polling).
+
+    Если передан clock (VirtualClock), все расчёты времени и JobQueue идут по нему.
+    study, rate_limiter и job_queue передаёт run_studies, когда ботов в процессе несколько;
+    по умолчанию — исследование из TOKEN/ADMIN_ID и собственные лимитер и очередь.
+    """
+    if study is None:
+        load_config()
+        study = current_study()
+    study.prepare()
+    STARTUP_TIMER.phase("конфигурация и каталоги")
+
+    builder = ApplicationBuilder().token(study.token).rate_limiter(
+        rate_limiter or PriorityRateLimiter(overall_rate=OUTBOUND_RATE, chat_rate=CHAT_RATE)
+    )
+    if clock is not None:
+        from clock import VirtualJobQueue
+        set_clock(clock)
+        builder = builder.job_queue(VirtualJobQueue(clock))
+    elif job_queue is not None:
+        builder = builder.job_queue(job_queue)
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_URL}/bot").base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+    if request is not None:
+        builder = builder.request(request)
+    if get_updates_request is not None:
+        builder = builder.get_updates_request(get_updates_request)
+    application = builder.build()
+    application.bot_data["study"] = study
 
     # Обработчики (ВАЖНО: правильный порядок!)
+    # Повтор уже обработанного апдейта (Telegram шлёт их заново после перезапуска) отбрасываем первым,
+    # а изменения участников пишем в журнал после всех обработчиков
+    journal_guard, journal_commit = study.journal.handlers(study.store)
+    application.add_handler(journal_guard, group=-3)
+    application.add_handler(study_handler(), group=-2)
+    # Хвост дневника, присланного несколькими сообщениями, склеивается с ответом — его лимит не режет
+    study.inbound.overflow = coalescible
+    application.add_handler(study.inbound.handler(), group=-1)
+    application.add_handler(journal_commit, group=1)
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("stats", stats))
     application.add_handler(CommandHandler("export", export_data))
     application.add_handler(CommandHandler("get_media", get_media))
     application.add_handler(CommandHandler("media_users", list_users_with_media))
+    application.add_handler(CommandHandler("cache_stats", cache_stats))
+    application.add_handler(CommandHandler("queue_stats", queue_stats))
+    application.add_handler(CommandHandler("search", search_answers))
+    application.add_handler(CommandHandler("report", report))
+    application.add_handler(CommandHandler("export_media", export_media))
+    application.add_handler(CommandHandler("profile", profile))
     application.add_handler(MessageHandler(filters.Regex(r"^(Да|Нет)$"), handle_care_question))
     application.add_handler(MessageHandler(filters.Regex(r"^\d{1,2}:\d{2}$"), handle_time))
     application.add_handler(MessageHandler(filters.PHOTO | filters.VIDEO | filters.Document.ALL, handle_media_message))
@@ -830,42 +1548,108 @@ def main():
 
     async def post_init(application):
         """Восстанавливаем расписание при запуске"""
-        logger.info("=== ВОССТАНОВЛЕНИЕ РАСПИСАНИЯ ===")
+        STARTUP_TIMER.phase("инициализация бота")
+        # Фоновые задачи копируют контекст — и вместе с ним исследование этого бота
+        token = CURRENT_STUDY.set(study)
+        try:
+            schedule_daily_check(application)
+            if not application.bot_data.get("shared_writer"):
+                application.bot_data["flush_task"] = asyncio.get_running_loop().create_task(
+                    flush_periodically([study])
+                )
 
-        restored_count = 0
-        reminder_count = 0
-        for uid, u in USER_DATA.items():
-            try:
-                chat_id = int(uid)
-            except Exception:
-                continue
+            if STARTUP_MODE == "eager":
+                await hydrate_and_restore(application)
+            else:
+                # Апдейты начинают обрабатываться сразу, участники подгружаются по требованию
+                application.bot_data["hydrate_task"] = asyncio.get_running_loop().create_task(
+                    hydrate_and_restore(application)
+                )
+        finally:
+            CURRENT_STUDY.reset(token)
 
-            if u.get("next_day_time"):
-                logger.info(f"Восстанавливаем для {chat_id}: время {u['next_day_time']}, день {u.get('day', 1)}")
+    async def post_shutdown(application):
+        """Сбрасываем всё несохранённое перед выходом"""
+        flush_task = application.bot_data.get("flush_task")
+        if flush_task:
+            flush_task.cancel()
+        study.close()
+        logger.info("Кэш участников %s при остановке: %s", study.name, study.store.metrics())
 
-                class DummyContext:
-                    def __init__(self, app):
-                        self.job_queue = app.job_queue
+    application.post_init = post_init
+    application.post_shutdown = post_shutdown
+    STARTUP_TIMER.phase("сборка приложения")
+    return application
 
-                dummy_context = DummyContext(application)
-                schedule_next_day(dummy_context, chat_id)
-                restored_count += 1
 
-            today = today_date_str()
-            if not u.get("answered_today") or u.get("last_response_date") != today:
-                class DummyContext:
-                    def __init__(self, app):
-                        self.job_queue = app.job_queue
+async def run_studies(config_path):
+    """Несколько исследований в одном процессе.
 
-                dummy_context = DummyContext(application)
-                schedule_reminders(dummy_context, chat_id)
-                reminder_count += 1
+    Общие на все боты: цикл событий, пул HTTP-соединений, PriorityRateLimiter
+    (общий лимит исходящих), планировщик заданий и фоновая запись на диск.
+    У каждого бота свои токен, участники, каталоги и сценарий.
+    """
+    import signal
 
-        schedule_daily_check(application)
+    from apscheduler.schedulers.asyncio import AsyncIOScheduler
+    from telegram.request import HTTPXRequest
 
-        logger.info(f"=== ВОССТАНОВЛЕНО {restored_count} ЗАДАНИЙ И {reminder_count} НАПОМИНАНИЙ ===")
+    from tenants import SharedJobQueue, SharedRequest
 
-    application.post_init = post_init
+    studies = load_studies(config_path, BASE_DIR, max_cached=CACHE_SIZE, ttl=CACHE_TTL, inbound=INBOUND_CONFIG,
+                            fsync=FSYNC)
+    request = SharedRequest(HTTPXRequest(connection_pool_size=max(8, 4 * len(studies))))
+    rate_limiter = PriorityRateLimiter(overall_rate=OUTBOUND_RATE, chat_rate=CHAT_RATE)
+    scheduler = AsyncIOScheduler()
+
+    applications = []
+    for study in studies:
+        # getUpdates у каждого бота свой: long polling держит соединение
+        application = build_application(
+            request=request, study=study, rate_limiter=rate_limiter, job_queue=SharedJobQueue(scheduler)
+        )
+        application.bot_data["shared_writer"] = True
+        applications.append(application)
+    writer = asyncio.get_running_loop().create_task(flush_periodically(studies))
+
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_running_loop().add_signal_handler(sig, stop.set)
+
+    try:
+        for application in applications:
+            await application.initialize()
+            await application.post_init(application)
+            await application.updater.start_polling()
+            await application.start()
+            logger.info("Исследование %s запущено (@%s)", application.bot_data["study"].name,
+                        application.bot.username)
+        logger.info("=== ЗАПУЩЕНО ИССЛЕДОВАНИЙ: %d ===", len(applications))
+        await stop.wait()
+    finally:
+        writer.cancel()
+        for application in reversed(applications):
+            if application.updater.running:
+                await application.updater.stop()
+            if application.running:
+                await application.stop()
+            await application.shutdown()
+            await application.post_shutdown(application)
+
+
+def main():
+    if STUDIES_CONFIG:
+        asyncio.run(run_studies(STUDIES_CONFIG))
+        return
+
+    application = build_application()
+
+    if SHARD_COUNT > 1:
+        from shard import run_worker
+        logger.info("=== ШАРД %d/%d ЗАПУЩЕН ===", SHARD_INDEX + 1, SHARD_COUNT)
+        collectors = {kind: functools.partial(run_collector, kind) for kind in ADMIN_COLLECTORS}
+        asyncio.run(run_worker(application, collectors, SHARD_PORT))
+        return
 
     logger.info("=== БОТ ЗАПУЩЕН ===")
     application.run_polling()
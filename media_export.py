@@ -0,0 +1,128 @@
+"""Выгрузка медиа участников ZIP-архивами частями.
+
+Каталог медиа строится по записям участников: у новых ответов путь к файлу
+лежит в answer["media"]["path"], у старых — в тексте «[прикреплено фото: ...]».
+Архив собирается без сжатия (JPEG и MP4 уже сжаты) прямо из исходных файлов,
+без промежуточной копии, и режется на части меньше лимита загрузки Telegram.
+В каждой части есть manifest.csv, связывающий файлы с ответами.
+"""
+import csv
+import io
+import os
+import re
+import shutil
+import zipfile
+
+from storage import answer_text, cohort_of
+
+# Лимит Telegram на загрузку файла ботом — 50 МБ, оставляем запас
+PART_LIMIT = 49 * 1024 * 1024
+
+LEGACY_MEDIA_RE = re.compile(r"\[прикреплено (фото|видео): ([^\]]+)\]")
+LEGACY_MEDIA_TYPES = {"фото": "photo", "видео": "video"}
+MANIFEST_FIELDS = ["file", "uid", "cohort", "kind", "date", "day", "message_id", "answered_at", "media_type", "text"]
+
+# Заголовки ZIP на один файл: локальный (30 байт) и в центральном каталоге (46 байт) плюс имя дважды
+_ENTRY_OVERHEAD = 30 + 46
+
+
+def catalogue(records, today, uids=None, day=None, date_from=None, date_to=None, cohort=None):
+    """Медиафайлы из ответов участников с учётом фильтров (JSON-совместимые словари); today — как в cohort_of()"""
+    entries = []
+    for uid, record in records:
+        if uids and uid not in uids:
+            continue
+        record_cohort = cohort_of(record, today)
+        if cohort and record_cohort != cohort:
+            continue
+
+        diary_dates = sorted(record.get("responses", {}))
+        for kind, answers in (("diary", record.get("responses", {})), ("care", record.get("care_responses", {}))):
+            for date, items in answers.items():
+                if (date_from and date < date_from) or (date_to and date > date_to):
+                    continue
+                if isinstance(items, str):
+                    items = [items]
+                legacy_day = diary_dates.index(date) + 1 if date in diary_dates else None
+                for answer in items:
+                    entry = {"uid": uid, "cohort": record_cohort, "kind": kind, "date": date, "day": legacy_day,
+                             "message_id": None, "answered_at": None, "text": answer_text(answer)}
+                    if isinstance(answer, dict):
+                        media = answer.get("media") or {}
+                        if not media.get("path"):
+                            continue
+                        entry.update(day=answer.get("day") or legacy_day, message_id=answer.get("message_id"),
+                                     answered_at=answer.get("answered_at"), media_type=media.get("type"),
+                                     path=media["path"])
+                    else:
+                        match = LEGACY_MEDIA_RE.search(answer)
+                        if not match:
+                            continue
+                        entry.update(media_type=LEGACY_MEDIA_TYPES[match.group(1)], path=match.group(2).strip(),
+                                     text=LEGACY_MEDIA_RE.sub("", answer).strip())
+                    if day is not None and entry["day"] != day:
+                        continue
+                    entries.append(entry)
+    entries.sort(key=lambda e: (e["uid"], e["date"], e["path"]))
+    return entries
+
+
+def _manifest(rows):
+    out = io.StringIO()
+    writer = csv.DictWriter(out, fieldnames=MANIFEST_FIELDS, extrasaction="ignore")
+    writer.writeheader()
+    writer.writerows(rows)
+    return out.getvalue().encode("utf-8-sig")
+
+
+def _finish(buffer, archive, rows):
+    archive.writestr("manifest.csv", _manifest(rows), compress_type=zipfile.ZIP_DEFLATED)
+    archive.close()
+    return buffer.getvalue()
+
+
+def _row_size(entry):
+    """Оценка размера строки манифеста (манифест сжимается, так что с запасом)"""
+    return len(entry["text"].encode("utf-8")) + 256
+
+
+def iter_parts(entries, limit=PART_LIMIT, skipped=None):
+    """Генератор частей архива: (байты ZIP, строки манифеста).
+
+    Файлы копируются в архив потоково; в памяти одновременно только текущая часть.
+    Отсутствующие и слишком большие файлы добавляются в skipped с причиной.
+    """
+    if skipped is None:
+        skipped = []
+    buffer = io.BytesIO()
+    archive = zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_STORED)
+    rows = []
+    manifest_size = 4096
+
+    for entry in entries:
+        path = entry["path"]
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            skipped.append(dict(entry, reason="файл не найден"))
+            continue
+
+        name = f"{entry['uid']}/day{entry['day'] or 0}_{os.path.basename(path)}"
+        needed = size + _ENTRY_OVERHEAD + 2 * len(name.encode("utf-8")) + _row_size(entry)
+        if needed + 4096 > limit:
+            skipped.append(dict(entry, reason="больше лимита части"))
+            continue
+        if rows and buffer.tell() + manifest_size + needed > limit:
+            yield _finish(buffer, archive, rows), rows
+            buffer = io.BytesIO()
+            archive = zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_STORED)
+            rows = []
+            manifest_size = 4096
+
+        with open(path, "rb") as src, archive.open(zipfile.ZipInfo.from_file(path, name), "w") as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        rows.append(dict(entry, file=name))
+        manifest_size += _row_size(entry)
+
+    if rows:
+        yield _finish(buffer, archive, rows), rows
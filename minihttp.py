@@ -0,0 +1,52 @@
+"""Минимальный HTTP/1.1-сервер на asyncio для внутренних нужд.
+
+Только то, что нужно фронту и воркерам шардов (shard.py) и фейковому Bot
+API (fake_telegram.py): keep-alive, тело по Content-Length, ответ целиком.
+Ни chunked, ни TLS — наружу он не смотрит.
+"""
+import asyncio
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+async def _handle(handler, reader, writer):
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            method, target, _ = request_line.decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                key, _, value = line.decode("latin-1").partition(":")
+                headers[key.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+            try:
+                status, raw = await handler(method, target, headers, body)
+            except Exception as e:
+                logger.exception("Ошибка обработки %s %s: %s", method, target, e)
+                status, raw = 500, json.dumps({"ok": False, "error": str(e)}, ensure_ascii=False).encode("utf-8")
+
+            writer.write(
+                f"HTTP/1.1 {status} OK\r\nContent-Type: application/json\r\n"
+                f"Content-Length: {len(raw)}\r\n\r\n".encode() + raw
+            )
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionResetError, ValueError) as e:
+        logger.debug("Соединение закрыто: %s", e)
+    except asyncio.CancelledError:
+        # Остановка процесса при открытом keep-alive соединении
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(handler, host, port):
+    """HTTP-сервер: handler(method, target, headers, body) -> (status, bytes)"""
+    return await asyncio.start_server(lambda r, w: _handle(handler, r, w), host, port)
@@ -0,0 +1,268 @@
+"""Единый диспетчер исходящих сообщений с приоритетными очередями.
+
+Подключается к python-telegram-bot как rate limiter, поэтому через него
+проходит каждый вызов Bot API. Запросы с chat_id встают в очередь своей
+полосы (lane) и получают разрешение на отправку по приоритету:
+interactive > day_message > reminder > apology. Общий лимит и лимит на чат
+— token bucket'ы. Полоса задаётся при отправке:
+
+    await context.bot.send_message(..., rate_limit_args={"lane": "reminder"})
+
+Без rate_limit_args запрос считается интерактивным ответом.
+"""
+import asyncio
+import logging
+import time
+from collections import Counter, deque
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from telegram.ext import BaseRateLimiter
+
+logger = logging.getLogger(__name__)
+
+LANES = ("interactive", "day_message", "reminder", "apology")
+DEFAULT_LANE = "interactive"
+
+# Ошибки, после которых писать в чат бессмысленно: бот заблокирован, аккаунт удалён, чата нет
+PERMANENT_ERRORS = ("forbidden", "chat_not_found")
+
+
+def classify_error(error):
+    """Вид ошибки доставки: forbidden, chat_not_found, bad_request, retry_after, network или other"""
+    if isinstance(error, Forbidden):
+        return "forbidden"
+    if isinstance(error, BadRequest):
+        return "chat_not_found" if "chat not found" in error.message.lower() else "bad_request"
+    if isinstance(error, RetryAfter):
+        return "retry_after"
+    if isinstance(error, NetworkError):
+        # В том числе TimedOut
+        return "network"
+    return "other"
+
+
+# Сколько ожидающих запросов одной полосы просматривать в поисках чата, которому можно отправлять
+SCAN_LIMIT = 100
+
+
+class TokenBucket:
+    """rate токенов в секунду, не больше capacity; rate=0 — без ограничений"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """Через сколько секунд будет доступен токен"""
+        if not self.rate:
+            return 0.0
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        if self.rate:
+            self._refill(now)
+            self.tokens -= 1
+
+    def full(self, now):
+        if not self.rate:
+            return True
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _Waiter:
+    __slots__ = ("lane", "chat_id", "future", "enqueued")
+
+    def __init__(self, lane, chat_id, future):
+        self.lane = lane
+        self.chat_id = chat_id
+        self.future = future
+        self.enqueued = time.monotonic()
+
+
+class PriorityRateLimiter(BaseRateLimiter):
+    """Rate limiter с приоритетными полосами и общим/початовым ограничением.
+
+    Один экземпляр может обслуживать несколько ботов процесса (см. tenants.py):
+    диспетчер запускается первым initialize() и останавливается последним shutdown().
+    """
+
+    def __init__(self, overall_rate=30, chat_rate=1, chat_burst=3, max_retries=2):
+        self.overall_rate = overall_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._lanes = {lane: deque() for lane in LANES}
+        self._overall = TokenBucket(overall_rate, max(1, overall_rate))
+        self._chats = {}
+        self._paused_until = 0.0
+        self._wakeup = None
+        self._task = None
+        self._users = 0
+        self._granted = 0
+        self.metrics = {
+            lane: {"enqueued": 0, "sent": 0, "failed": 0, "max_depth": 0, "total_wait": 0.0, "max_wait": 0.0,
+                   "errors": Counter()}
+            for lane in LANES
+        }
+
+    async def initialize(self):
+        self._users += 1
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._dispatch())
+
+    async def shutdown(self):
+        self._users = max(0, self._users - 1)
+        if self._task is not None and self._users == 0:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _pick(self, now):
+        """Первый запрос наивысшего приоритета, чату которого сейчас можно отправлять"""
+        for lane in LANES:
+            queue = self._lanes[lane]
+            i = 0
+            while i < len(queue) and i < SCAN_LIMIT:
+                waiter = queue[i]
+                if waiter.future.done():
+                    # Отправитель отменил ожидание
+                    del queue[i]
+                    continue
+                if self._chat_bucket(waiter.chat_id).delay(now) == 0:
+                    del queue[i]
+                    return waiter
+                i += 1
+        return None
+
+    def _next_delay(self, now):
+        delays = []
+        for queue in self._lanes.values():
+            for i, waiter in enumerate(queue):
+                if i >= SCAN_LIMIT:
+                    break
+                if not waiter.future.done():
+                    delays.append(self._chat_bucket(waiter.chat_id).delay(now))
+        return min(delays) if delays else None
+
+    def _prune_chats(self, now):
+        for chat_id in [c for c, bucket in self._chats.items() if bucket.full(now)]:
+            del self._chats[chat_id]
+
+    async def _dispatch(self):
+        while True:
+            now = time.monotonic()
+            if self._paused_until > now:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+
+            overall_delay = self._overall.delay(now)
+            if overall_delay:
+                await asyncio.sleep(overall_delay)
+                continue
+
+            waiter = self._pick(now)
+            if waiter is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self._next_delay(now))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self._overall.take(now)
+            self._chat_bucket(waiter.chat_id).take(now)
+            waiter.future.set_result(None)
+
+            self._granted += 1
+            if self._granted % 10000 == 0:
+                self._prune_chats(now)
+            # Даём отправителю шанс стартовать до выдачи следующего разрешения
+            await asyncio.sleep(0)
+
+    async def _wait_turn(self, lane, chat_id):
+        waiter = _Waiter(lane, chat_id, asyncio.get_running_loop().create_future())
+        queue = self._lanes[lane]
+        queue.append(waiter)
+        stats = self.metrics[lane]
+        stats["enqueued"] += 1
+        stats["max_depth"] = max(stats["max_depth"], len(queue))
+        self._wakeup.set()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            waiter.future.cancel()
+            raise
+        waited = time.monotonic() - waiter.enqueued
+        stats["total_wait"] += waited
+        stats["max_wait"] = max(stats["max_wait"], waited)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if chat_id is None or self._task is None:
+            # getUpdates, getFile и прочие служебные вызовы идут без очереди
+            return await callback(*args, **kwargs)
+
+        lane = DEFAULT_LANE
+        if isinstance(rate_limit_args, dict):
+            lane = rate_limit_args.get("lane", DEFAULT_LANE)
+        if lane not in self._lanes:
+            lane = DEFAULT_LANE
+
+        for attempt in range(self.max_retries + 1):
+            await self._wait_turn(lane, chat_id)
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after + 0.1)
+                logger.warning("Telegram просит подождать %s с (%s, попытка %d)", retry_after, lane, attempt + 1)
+                if attempt == self.max_retries:
+                    self.metrics[lane]["failed"] += 1
+                    self.metrics[lane]["errors"]["retry_after"] += 1
+                    raise
+                continue
+            except Exception as e:
+                self.metrics[lane]["failed"] += 1
+                self.metrics[lane]["errors"][classify_error(e)] += 1
+                raise
+            self.metrics[lane]["sent"] += 1
+            return result
+
+    def report(self):
+        """Глубина очередей и время ожидания по полосам"""
+        report = {}
+        for lane in LANES:
+            stats = self.metrics[lane]
+            granted = stats["sent"] + stats["failed"]
+            report[lane] = {
+                "depth": len(self._lanes[lane]),
+                "max_depth": stats["max_depth"],
+                "enqueued": stats["enqueued"],
+                "sent": stats["sent"],
+                "failed": stats["failed"],
+                "errors": dict(stats["errors"]),
+                "success_rate": round(stats["sent"] / granted, 4) if granted else None,
+                "avg_wait_ms": round(stats["total_wait"] / granted * 1000, 2) if granted else 0.0,
+                "max_wait_ms": round(stats["max_wait"] * 1000, 2),
+            }
+        return report
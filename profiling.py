@@ -0,0 +1,72 @@
+"""Профилирование работающего бота по команде администратора.
+
+На время окна включаются cProfile (всё, что выполняется в потоке цикла
+событий: обработчики, задания JobQueue, запись участников) и tracemalloc.
+Вне окна ничего не включено, накладных расходов нет.
+"""
+import cProfile
+import io
+import pstats
+import time
+import tracemalloc
+
+
+class ProfileSession:
+    """Одно окно профилирования: start() ... stop() -> текстовый отчёт"""
+
+    active = None
+
+    def __init__(self, frames=10):
+        self.frames = frames
+        self.profiler = cProfile.Profile()
+        self.started = None
+        self.snapshot = None
+        self._own_tracemalloc = False
+
+    def start(self):
+        if ProfileSession.active is not None:
+            raise RuntimeError("профилирование уже запущено")
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self._own_tracemalloc = True
+        self.snapshot = tracemalloc.take_snapshot()
+        self.started = time.perf_counter()
+        self.profiler.enable()
+        ProfileSession.active = self
+
+    def stop(self):
+        self.profiler.disable()
+        elapsed = time.perf_counter() - self.started
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        if self._own_tracemalloc:
+            tracemalloc.stop()
+        ProfileSession.active = None
+        return elapsed, snapshot, current, peak
+
+    def report(self, top=40):
+        """Останавливает профилирование и возвращает отчёт"""
+        elapsed, snapshot, current, peak = self.stop()
+        out = io.StringIO()
+        out.write(f"Окно профилирования: {elapsed:.1f} с\n")
+        out.write(f"tracemalloc: сейчас {current / 1024 / 1024:.1f} МБ, пик {peak / 1024 / 1024:.1f} МБ\n\n")
+
+        stats = pstats.Stats(self.profiler, stream=out)
+        stats.strip_dirs()
+        out.write(f"=== Топ {top} функций по накопленному времени ===\n")
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(top)
+        out.write(f"\n=== Топ {top // 2} функций по собственному времени ===\n")
+        stats.sort_stats(pstats.SortKey.TIME).print_stats(top // 2)
+
+        ignore = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen importlib._bootstrap>")]
+        diff = snapshot.filter_traces(ignore).compare_to(self.snapshot.filter_traces(ignore), "lineno")
+        out.write(f"\n=== Топ {top // 2} мест выделения памяти за окно ===\n")
+        for stat in diff[:top // 2]:
+            out.write(f"{stat}\n")
+
+        out.write(f"\n=== Топ {top // 4} мест выделения памяти (всего, с трассой) ===\n")
+        for stat in snapshot.filter_traces(ignore).statistics("traceback")[:top // 4]:
+            out.write(f"{stat.size / 1024:.1f} КБ в {stat.count} блоках\n")
+            for line in stat.traceback.format()[-6:]:
+                out.write(f"    {line}\n")
+        return out.getvalue()
@@ -0,0 +1,249 @@
+"""Полнотекстовый поиск по ответам участников (SQLite FTS5 + русский стемминг).
+
+В FTS-индекс пишутся основы слов (стеммер Snowball для русского языка),
+поэтому «пятно», «пятна» и «пятнами» находятся одним запросом. Индекс
+пополняется сохранёнными ответами (пачками, вместе со сбросом кэша
+участников) и хранится рядом с данными.
+"""
+import asyncio
+import html
+import logging
+import re
+import sqlite3
+
+from storage import answer_text
+
+logger = logging.getLogger(__name__)
+
+WORD_RE = re.compile(r"[0-9a-zа-яё]+", re.IGNORECASE)
+
+_VOWELS = "аеиоуыэюя"
+_PERFECTIVE_GERUND_1 = ("вшись", "вши", "в")
+_PERFECTIVE_GERUND_2 = ("ывшись", "ившись", "ывши", "ивши", "ыв", "ив")
+_ADJECTIVE = ("ими", "ыми", "его", "ого", "ему", "ому", "ее", "ие", "ые", "ое", "ей", "ий", "ый", "ой",
+              "ем", "им", "ым", "ом", "их", "ых", "ую", "юю", "ая", "яя", "ою", "ею")
+_PARTICIPLE_1 = ("ем", "нн", "вш", "ющ", "щ")
+_PARTICIPLE_2 = ("ивш", "ывш", "ующ")
+_REFLEXIVE = ("ся", "сь")
+_VERB_1 = ("ете", "йте", "ешь", "нно", "ла", "на", "ли", "ем", "ло", "но", "ет", "ют", "ны", "ть", "й", "л", "н")
+_VERB_2 = ("ейте", "уйте", "ила", "ыла", "ена", "ите", "или", "ыли", "ило", "ыло", "ено", "ует", "уют", "ены",
+           "ить", "ыть", "ишь", "ей", "уй", "ил", "ыл", "им", "ым", "ен", "ят", "ит", "ыт", "ую", "ю")
+_NOUN = ("иями", "ями", "ами", "ией", "иям", "ием", "иях", "ев", "ов", "ие", "ье", "еи", "ии", "ей", "ой", "ий",
+         "ям", "ем", "ам", "ом", "ах", "ях", "ию", "ью", "ия", "ья", "а", "е", "и", "й", "о", "у", "ы", "ь", "ю", "я")
+_SUPERLATIVE = ("ейше", "ейш")
+_DERIVATIONAL = ("ость", "ост")
+
+
+def _region(word, start):
+    for i in range(start + 1, len(word)):
+        if word[i] not in _VOWELS and word[i - 1] in _VOWELS:
+            return i + 1
+    return len(word)
+
+
+def _strip(word, start, endings, after_a=False):
+    """Отрезает самое длинное окончание из endings, целиком лежащее в word[start:]"""
+    for ending in sorted(endings, key=len, reverse=True):
+        if word.endswith(ending) and len(word) - len(ending) >= start:
+            if after_a:
+                pos = len(word) - len(ending)
+                if pos - 1 < start or word[pos - 1] not in "ая":
+                    continue
+            return word[:-len(ending)]
+    return None
+
+
+def stem(word):
+    """Основа русского слова по алгоритму Snowball"""
+    word = word.lower().replace("ё", "е")
+    rv = next((i + 1 for i, ch in enumerate(word) if ch in _VOWELS), len(word))
+    r2 = _region(word, _region(word, 0))
+
+    stripped = _strip(word, rv, _PERFECTIVE_GERUND_1, after_a=True) or _strip(word, rv, _PERFECTIVE_GERUND_2)
+    if stripped is not None:
+        word = stripped
+    else:
+        word = _strip(word, rv, _REFLEXIVE) or word
+        adjective = _strip(word, rv, _ADJECTIVE)
+        if adjective is not None:
+            word = (_strip(adjective, rv, _PARTICIPLE_1, after_a=True)
+                    or _strip(adjective, rv, _PARTICIPLE_2) or adjective)
+        else:
+            verb = _strip(word, rv, _VERB_1, after_a=True) or _strip(word, rv, _VERB_2)
+            if verb is not None:
+                word = verb
+            else:
+                word = _strip(word, rv, _NOUN) or word
+
+    if word.endswith("и") and len(word) - 1 >= rv:
+        word = word[:-1]
+
+    word = _strip(word, r2, _DERIVATIONAL) or word
+
+    if word.endswith("нн") and len(word) - 1 >= rv:
+        word = word[:-1]
+    else:
+        superlative = _strip(word, rv, _SUPERLATIVE)
+        if superlative is not None:
+            word = superlative[:-1] if superlative.endswith("нн") else superlative
+        elif word.endswith("ь") and len(word) - 1 >= rv:
+            word = word[:-1]
+    return word
+
+
+def stems(text):
+    return [stem(w) for w in WORD_RE.findall(text or "")]
+
+
+def snippet(text, query_stems, width=60):
+    """Кусок текста вокруг первого совпадения, совпавшие слова выделены <b>"""
+    matches = [m for m in WORD_RE.finditer(text) if any(stem(m.group()).startswith(q) for q in query_stems)]
+    if not matches:
+        return html.escape(text[:width * 2])
+    start = max(0, matches[0].start() - width)
+    end = min(len(text), matches[0].end() + width)
+    parts = []
+    pos = start
+    for m in matches:
+        if m.start() < start or m.end() > end:
+            continue
+        parts.append(html.escape(text[pos:m.start()]))
+        parts.append(f"<b>{html.escape(m.group())}</b>")
+        pos = m.end()
+    parts.append(html.escape(text[pos:end]))
+    return ("…" if start else "") + "".join(parts) + ("…" if end < len(text) else "")
+
+
+class SearchIndex:
+    """FTS5-индекс ответов: одна строка на ответ (дневник или уход за одеждой)"""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._db = None
+        self._pending = []
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.db_path)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS answers (
+                    id INTEGER PRIMARY KEY,
+                    key TEXT UNIQUE,
+                    uid TEXT,
+                    date TEXT,
+                    day INTEGER,
+                    kind TEXT,
+                    text TEXT
+                );
+                CREATE INDEX IF NOT EXISTS answers_date ON answers(date);
+                CREATE VIRTUAL TABLE IF NOT EXISTS answers_fts USING fts5(stems, tokenize='unicode61');
+            """)
+        return self._db
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+
+    def _add(self, uid, kind, date, day, position, text):
+        key = f"{uid}:{kind}:{date}:{position}"
+        row = self.db.execute("SELECT id FROM answers WHERE key = ?", (key,)).fetchone()
+        if row:
+            self.db.execute("UPDATE answers SET text = ?, day = ? WHERE id = ?", (text, day, row[0]))
+            self.db.execute("DELETE FROM answers_fts WHERE rowid = ?", (row[0],))
+            doc_id = row[0]
+        else:
+            doc_id = self.db.execute(
+                "INSERT INTO answers (key, uid, date, day, kind, text) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, uid, date, day, kind, text),
+            ).lastrowid
+        self.db.execute("INSERT INTO answers_fts (rowid, stems) VALUES (?, ?)", (doc_id, " ".join(stems(text))))
+
+    def add(self, uid, kind, date, day, position, text):
+        """Ставит ответ в очередь на индексацию; kind — diary или care"""
+        self._pending.append((uid, kind, date, day, position, text))
+
+    def flush(self):
+        """Записывает накопленные ответы одной транзакцией"""
+        if not self._pending:
+            return 0
+        pending, self._pending = self._pending, []
+        try:
+            with self.db:
+                for answer in pending:
+                    self._add(*answer)
+        except sqlite3.Error as e:
+            logger.exception("Ошибка при индексации %d ответов: %s", len(pending), e)
+            return 0
+        return len(pending)
+
+    def add_record(self, uid, record):
+        """Индексирует все ответы участника (используется при перестроении)"""
+        dates = sorted(record.get("responses", {}))
+        for kind, answers in (("diary", record.get("responses", {})), ("care", record.get("care_responses", {}))):
+            for date, items in answers.items():
+                if isinstance(items, str):
+                    items = [items]
+                day = dates.index(date) + 1 if date in dates else None
+                for position, answer in enumerate(items):
+                    if isinstance(answer, dict) and answer.get("day"):
+                        day = answer["day"]
+                    self._add(uid, kind, date, day, position, answer_text(answer))
+
+    def reindex(self, records):
+        """Индексирует ответы участников одной транзакцией (например, восстановленных из журнала)"""
+        count = 0
+        with self.db:
+            for uid, record in records:
+                self.add_record(uid, record)
+                count += 1
+        return count
+
+    async def rebuild(self, records, batch_size=500):
+        """Переиндексирует всех участников, отдавая управление циклу между пачками"""
+        with self.db:
+            self.db.execute("DELETE FROM answers")
+            self.db.execute("DELETE FROM answers_fts")
+        count = 0
+        for uid, record in records:
+            with self.db:
+                self.add_record(uid, record)
+            count += 1
+            if count % batch_size == 0:
+                await asyncio.sleep(0)
+        return count
+
+    def search(self, query, day=None, date_from=None, date_to=None, limit=10):
+        """Ответы по убыванию релевантности (bm25) с фрагментами текста"""
+        self.flush()
+        query_stems = [s for s in stems(query) if s]
+        if not query_stems:
+            return []
+        match = " ".join(f'"{s}"*' for s in query_stems)
+        sql = ("SELECT a.uid, a.date, a.day, a.kind, a.text, bm25(answers_fts) AS score "
+               "FROM answers_fts JOIN answers a ON a.id = answers_fts.rowid WHERE answers_fts MATCH ?")
+        params = [match]
+        if day is not None:
+            sql += " AND a.day = ?"
+            params.append(day)
+        if date_from:
+            sql += " AND a.date >= ?"
+            params.append(date_from)
+        if date_to:
+            sql += " AND a.date <= ?"
+            params.append(date_to)
+        sql += " ORDER BY score LIMIT ?"
+        params.append(limit)
+
+        return [
+            {"uid": uid, "date": date, "day": day, "kind": kind, "score": score,
+             "snippet": snippet(text, query_stems)}
+            for uid, date, day, kind, text, score in self.db.execute(sql, params)
+        ]
+
+    def close(self):
+        self.flush()
+        if self._db is not None:
+            self._db.close()
+            self._db = None
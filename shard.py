@@ -0,0 +1,366 @@
+"""Шардирование участников по нескольким процессам-воркерам.
+
+Фронт принимает апдейты (webhook или getUpdates) и по хэшу chat_id
+пересылает каждый в свой воркер. Воркер — обычный main.py с переменными
+SHARD_INDEX/SHARD_COUNT/SHARD_PORT: у него свои участники, своё расписание
+и свой каталог данных. Админские команды собирают ответ со всех шардов.
+
+Локальный запуск на одной машине (4 воркера, апдейты через getUpdates):
+    TOKEN=... ADMIN_ID=... python shard.py --workers 4 --poll
+
+С webhook'ом:
+    python shard.py --workers 4 --port 8443 --webhook-url https://example.org/webhook
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import zlib
+from urllib.parse import urlsplit
+
+import httpx
+
+import minihttp
+
+logger = logging.getLogger(__name__)
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def shard_for(chat_id, shard_count):
+    """Номер шарда для чата — стабилен между перезапусками"""
+    return zlib.crc32(str(chat_id).encode()) % shard_count
+
+
+def update_chat_id(update):
+    """chat_id из JSON апдейта (или id отправителя), None если его нет"""
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat and "id" in chat:
+            return chat["id"]
+        sender = value.get("from")
+        if sender and "id" in sender:
+            return sender["id"]
+    return None
+
+
+# --- JSON поверх minihttp для обмена между фронтом и воркерами ---
+
+async def serve_json(handler, host, port):
+    """HTTP-сервер: handler(method, path, payload, headers) -> (status, dict)"""
+    async def raw_handler(method, target, headers, body):
+        payload = json.loads(body) if body else None
+        status, result = await handler(method, urlsplit(target).path, payload, headers)
+        return status, json.dumps(result, ensure_ascii=False).encode("utf-8")
+
+    return await minihttp.serve(raw_handler, host, port)
+
+
+# --- Воркер ---
+
+async def serve_worker(application, collectors, port, host="127.0.0.1"):
+    """Принимает апдейты от фронта и отвечает на админские запросы других шардов"""
+    from telegram import Update
+
+    async def handler(method, path, payload, headers):
+        if method == "POST" and path == "/update":
+            await application.update_queue.put(Update.de_json(payload, application.bot))
+            return 200, {"ok": True}
+        if method == "POST" and path.startswith("/admin/"):
+            collector = collectors.get(path[len("/admin/"):])
+            if collector is None:
+                return 404, {"ok": False}
+            return 200, {"ok": True, "result": await collector(payload)}
+        return 404, {"ok": False}
+
+    server = await serve_json(handler, host, port)
+    logger.info("Шард слушает http://%s:%s", host, port)
+    return server
+
+
+async def gather(kind, payload, peers, self_index, local):
+    """Собирает результат коллектора kind со всех шардов (свой — без HTTP, local — корутинная функция)"""
+    async def ask(peer):
+        async with httpx.AsyncClient(timeout=60) as client:
+            response = await client.post(f"{peer}/admin/{kind}", json=payload)
+            response.raise_for_status()
+            return response.json()["result"]
+
+    tasks = [local(payload) if i == self_index else ask(peer) for i, peer in enumerate(peers)]
+    return await asyncio.gather(*tasks)
+
+
+async def run_worker(application, collectors, port):
+    """Жизненный цикл воркера: без polling, апдейты приходят от фронта"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    server = await serve_worker(application, collectors, port)
+    try:
+        await stop.wait()
+    finally:
+        server.close()
+        await application.stop()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        await application.shutdown()
+
+
+# --- Фронт ---
+
+class Front:
+    """Раздаёт апдейты воркерам по хэшу chat_id, сохраняя порядок внутри шарда"""
+
+    def __init__(self, worker_urls):
+        self.worker_urls = worker_urls
+        self.queues = [asyncio.Queue() for _ in worker_urls]
+        self.client = httpx.AsyncClient(timeout=30)
+        self.routed = [0] * len(worker_urls)
+
+    def route(self, update):
+        """Ставит апдейт в очередь шарда; future завершится, когда воркер его примет"""
+        chat_id = update_chat_id(update)
+        index = shard_for(chat_id, len(self.worker_urls)) if chat_id is not None else 0
+        self.routed[index] += 1
+        forwarded = asyncio.get_running_loop().create_future()
+        self.queues[index].put_nowait((update, forwarded))
+        return forwarded
+
+    async def _forward(self, index):
+        url = f"{self.worker_urls[index]}/update"
+        queue = self.queues[index]
+        while True:
+            update, forwarded = await queue.get()
+            while True:
+                try:
+                    response = await self.client.post(url, json=update)
+                    response.raise_for_status()
+                    break
+                except httpx.HTTPError as e:
+                    # Воркер ещё стартует или перезапускается — повторяем, не теряя порядок
+                    logger.warning("Шард %d недоступен (%s), повтор через 1 с", index, e)
+                    await asyncio.sleep(1)
+            if not forwarded.done():
+                forwarded.set_result(True)
+
+    def start(self):
+        return [asyncio.get_running_loop().create_task(self._forward(i)) for i in range(len(self.queues))]
+
+    async def poll(self, api_url, token):
+        offset = None
+        while True:
+            params = {"timeout": 30}
+            if offset is not None:
+                params["offset"] = offset
+            try:
+                response = await self.client.get(f"{api_url}/bot{token}/getUpdates", params=params, timeout=40)
+                updates = response.json().get("result", [])
+            except (httpx.HTTPError, ValueError) as e:
+                logger.warning("Ошибка getUpdates: %s", e)
+                await asyncio.sleep(1)
+                continue
+            if not updates:
+                continue
+            # offset подтверждает апдейты Telegram — сдвигаем его, только когда воркеры их приняли,
+            # иначе при остановке фронта апдейты из очередей пропали бы
+            await asyncio.gather(*(self.route(update) for update in updates))
+            offset = updates[-1]["update_id"] + 1
+
+    async def serve_webhook(self, port, secret=None):
+        async def handler(method, path, payload, headers):
+            if method != "POST" or path != "/webhook":
+                return 404, {"ok": False}
+            if secret and headers.get("x-telegram-bot-api-secret-token") != secret:
+                return 403, {"ok": False}
+            # 200 подтверждает апдейт: до этого Telegram пришлёт его повторно
+            await self.route(payload)
+            return 200, {"ok": True}
+
+        return await serve_json(handler, "0.0.0.0", port)
+
+
+def _shard_dirs(root):
+    """[(номер шарда или None для несшардированного запуска, каталог)] из существующих"""
+    found = [(None, root)] if os.path.isdir(root) else []
+    for name in sorted(os.listdir(root)) if found else []:
+        suffix = name[len("shard_"):]
+        if name.startswith("shard_") and suffix.isdigit() and os.path.isdir(os.path.join(root, name)):
+            found.append((int(suffix), os.path.join(root, name)))
+    return found
+
+
+def _keep_newer(source, target):
+    """Переносит файл source в target; если target уже есть, более старый из двух откладывается в .stale"""
+    if os.path.exists(target):
+        older, newer = (source, target) if os.path.getmtime(source) <= os.path.getmtime(target) else (target, source)
+        logger.warning("Участник есть и в %s, и в %s: оставляем более новый, старый — в .stale", source, target)
+        os.replace(older, older + ".stale")
+        if newer == target:
+            return
+    os.replace(source, target)
+
+
+def redistribute(base_dir, count):
+    """Раскладывает участников по каталогам шардов до запуска воркеров.
+
+    Воркер видит только свой user_data/shard_<i>, поэтому сюда переносятся:
+    старый user_data.json, файлы несшардированного запуска (user_data/*.json),
+    файлы и архивы, оставшиеся от запуска с другим числом шардов. Незавершённые
+    журналы сначала доигрываются в файлы. В затронутых каталогах удаляется
+    поисковый индекс — воркер перестроит его при старте.
+    """
+    from journal import UpdateJournal
+    from storage import ParticipantArchive, ParticipantStore, write_atomic
+
+    data_root = os.path.join(base_dir, "user_data")
+    archive_root = os.path.join(base_dir, "archive")
+    target_dirs = [os.path.join(data_root, f"shard_{i}") for i in range(count)]
+    target_archives = [os.path.join(archive_root, f"shard_{i}") for i in range(count)]
+    changed = set()
+
+    sources = _shard_dirs(data_root)
+    for index, data_dir in sources:
+        archive_dir = archive_root if index is None else os.path.join(archive_root, f"shard_{index}")
+        journal = UpdateJournal(data_dir)
+        try:
+            ParticipantStore(data_dir, archive_dir=archive_dir, journal=journal).prepare()
+        finally:
+            journal.close()
+
+    legacy_file = os.path.join(base_dir, "user_data.json")
+    if os.path.exists(legacy_file):
+        try:
+            with open(legacy_file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except ValueError as e:
+            raise RuntimeError(f"{legacy_file} повреждён, перенос остановлен: {e}") from e
+        for uid, record in data.items():
+            target_dir = target_dirs[shard_for(uid, count)]
+            os.makedirs(target_dir, exist_ok=True)
+            path = os.path.join(target_dir, f"{uid}.json")
+            if not os.path.exists(path):
+                write_atomic(path, json.dumps(record, ensure_ascii=False, indent=2).encode("utf-8"))
+                changed.add(target_dir)
+        os.replace(legacy_file, legacy_file + ".migrated")
+        logger.info("Перенесено %d участников из %s по %d шардам", len(data), legacy_file, count)
+
+    moved = 0
+    for index, data_dir in sources:
+        for name in os.listdir(data_dir):
+            if not name.endswith(".json"):
+                continue
+            shard = shard_for(name[:-5], count)
+            if index == shard:
+                continue
+            os.makedirs(target_dirs[shard], exist_ok=True)
+            _keep_newer(os.path.join(data_dir, name), os.path.join(target_dirs[shard], name))
+            changed.update((data_dir, target_dirs[shard]))
+            moved += 1
+
+    # Один объект на каталог: индекс архива держится в памяти
+    archives = {}
+    for index, archive_dir in _shard_dirs(archive_root):
+        archive = archives.setdefault(archive_dir, ParticipantArchive(archive_dir))
+        for uid, record in list(archive.iter_records()):
+            shard = shard_for(uid, count)
+            if index == shard:
+                continue
+            target = target_archives[shard]
+            # Когорта остаётся прежней: её уже видели отчёты
+            archives.setdefault(target, ParticipantArchive(target)).add(uid, record, archive.index[uid])
+            archive.remove(uid)
+            moved += 1
+    for archive in archives.values():
+        archive.close()
+
+    for data_dir in changed:
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.remove(os.path.join(data_dir, "search.sqlite3" + suffix))
+            except FileNotFoundError:
+                pass
+    if moved:
+        logger.info("Участников перенесено между каталогами шардов: %d", moved)
+
+
+def spawn_workers(count, base_port):
+    peers = ",".join(f"http://127.0.0.1:{base_port + i}" for i in range(count))
+    # Лимит Telegram общий на токен: каждый воркер получает свою долю OUTBOUND_RATE
+    outbound_rate = float(os.environ.get("OUTBOUND_RATE", 30)) / count
+    processes = []
+    for i in range(count):
+        env = dict(os.environ, SHARD_INDEX=str(i), SHARD_COUNT=str(count),
+                   SHARD_PORT=str(base_port + i), SHARD_PEERS=peers, OUTBOUND_RATE=str(outbound_rate))
+        processes.append(subprocess.Popen([sys.executable, os.path.join(ROOT_DIR, "main.py")], env=env))
+    return processes, peers.split(",")
+
+
+async def run_front(args):
+    token = os.environ.get("TOKEN")
+    if not token:
+        print("❌ ERROR: TOKEN environment variable is not set!")
+        sys.exit(1)
+    api_url = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org")
+    secret = os.environ.get("WEBHOOK_SECRET")
+
+    # Каталоги делятся до запуска воркеров: иначе каждый видел бы чужих участников или не видел своих
+    redistribute(os.getcwd(), args.workers)
+    processes, worker_urls = spawn_workers(args.workers, args.base_port)
+    front = Front(worker_urls)
+    tasks = front.start()
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    server = None
+    try:
+        if args.poll:
+            await front.client.post(f"{api_url}/bot{token}/deleteWebhook")
+            tasks.append(loop.create_task(front.poll(api_url, token)))
+        else:
+            server = await front.serve_webhook(args.port, secret)
+            if args.webhook_url:
+                params = {"url": args.webhook_url}
+                if secret:
+                    params["secret_token"] = secret
+                await front.client.post(f"{api_url}/bot{token}/setWebhook", json=params)
+        logger.info("Фронт запущен: %d шардов", args.workers)
+        await stop.wait()
+    finally:
+        for task in tasks:
+            task.cancel()
+        if server:
+            server.close()
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+        await front.client.aclose()
+        logger.info("Фронт остановлен, апдейтов по шардам: %s", front.routed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Шардированный запуск бота-дневника")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--base-port", type=int, default=9100, help="Порт первого воркера")
+    parser.add_argument("--port", type=int, default=8443, help="Порт webhook'а фронта")
+    parser.add_argument("--webhook-url", help="Публичный URL webhook'а (вызывает setWebhook)")
+    parser.add_argument("--poll", action="store_true", help="Получать апдейты через getUpdates вместо webhook'а")
+    args = parser.parse_args()
+    from logs import setup_logging
+    setup_logging()
+    asyncio.run(run_front(args))
@@ -0,0 +1,691 @@
+"""Хранилище участников: по одному JSON-файлу на пользователя.
+
+Запись одного участника не требует перезаписи всех остальных, а записи
+читаются с диска по требованию — бот может принимать сообщения ещё до
+того, как все участники загружены в память.
+
+В памяти держится ограниченный LRU-кэш «горячих» участников. Изменения
+пишутся на диск при вытеснении из кэша и периодическим flush().
+
+Завершившие исследование участники переносятся в сжатый архив
+(ParticipantArchive) и больше не попадают в ночные обходы.
+
+Файл участника пишется атомарно (временный файл и os.replace), так что
+при падении посреди записи на диске остаётся старая версия. Изменения
+между записями защищает журнал апдейтов (journal.py), если он подключён.
+
+Долгие админские чтения (выгрузки, статистика, отчёты) идут по снимку
+(StoreSnapshot) — согласованному срезу на момент его создания, который
+можно обходить из другого потока, пока обработчики продолжают писать.
+"""
+import asyncio
+import gzip
+import io
+import json
+import logging
+import os
+import threading
+import time
+import weakref
+import zlib
+from collections import OrderedDict
+from datetime import date
+
+logger = logging.getLogger(__name__)
+
+
+def write_atomic(path, raw, fsync=True):
+    """Запись файла целиком: временный файл, fsync и os.replace — файл либо старый, либо новый"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(raw)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def answer_text(answer):
+    """Текст ответа: старые записи — просто строка, новые — словарь с полем text"""
+    if isinstance(answer, dict):
+        return answer.get("text") or ""
+    return answer
+
+
+def cohort_of(record, today):
+    """Когорта участника — ISO-неделя начала исследования, например 2026-W02.
+
+    today — дата по часам бота (ISO); берётся, только если в записи нет ни одной своей даты.
+    """
+    started = record.get("started_date")
+    if not started:
+        dates = sorted(record.get("responses", {})) or [record.get("completed_date") or today]
+        started = dates[0]
+    year, week, _ = date.fromisoformat(started).isocalendar()
+    return f"{year}-W{week:02d}"
+
+
+class ParticipantArchive:
+    """Архив завершивших участников: по gzip-файлу JSON Lines на когорту.
+
+    Индекс uid -> когорта хранится в index.json и журнале дозаписи index.log:
+    перенос участника дописывает одну строку, а index.json переписывается
+    целиком, только когда журнал разрастается. Для чтения одной записи
+    запоминается, где в файле когорты лежит её gzip-member.
+    """
+
+    # Журнал индекса сворачивается в index.json, когда в нём больше строк, чем это или записей в индексе
+    COMPACT_LINES = 1000
+
+    def __init__(self, archive_dir, fsync=True):
+        self.archive_dir = archive_dir
+        self.fsync = fsync
+        self._index = None
+        self._log_lines = 0
+        self._log_fd = None
+        # когорта -> {uid: (смещение, длина)} последней записи участника в файле когорты
+        self._offsets = {}
+
+    @property
+    def index_path(self):
+        return os.path.join(self.archive_dir, "index.json")
+
+    @property
+    def log_path(self):
+        return os.path.join(self.archive_dir, "index.log")
+
+    def _cohort_path(self, cohort):
+        return os.path.join(self.archive_dir, f"cohort_{cohort}.jsonl.gz")
+
+    @property
+    def index(self):
+        """uid -> когорта"""
+        if self._index is None:
+            try:
+                with open(self.index_path, "r", encoding="utf-8") as f:
+                    index = json.load(f)
+            except FileNotFoundError:
+                index = {}
+            try:
+                with open(self.log_path, "rb") as f:
+                    lines = f.read().split(b"\n")
+            except FileNotFoundError:
+                lines = []
+            for line in lines:
+                if not line.strip():
+                    continue
+                try:
+                    uid, cohort = json.loads(line)
+                except ValueError:
+                    # Оборванная последняя строка: запись когорты без строки индекса не видна, как и до переноса
+                    logger.warning("Журнал индекса архива %s повреждён, строка пропущена", self.log_path)
+                    continue
+                self._log_lines += 1
+                if cohort is None:
+                    index.pop(uid, None)
+                else:
+                    index[uid] = cohort
+            self._index = index
+        return self._index
+
+    def _log(self, uid, cohort):
+        """Дописывает изменение индекса; при длинном журнале сворачивает его в index.json"""
+        if self._log_lines >= max(self.COMPACT_LINES, len(self.index)):
+            self.compact()
+        if self._log_fd is None:
+            self._log_fd = os.open(self.log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        os.write(self._log_fd, (json.dumps([uid, cohort]) + "\n").encode("utf-8"))
+        if self.fsync:
+            os.fsync(self._log_fd)
+        self._log_lines += 1
+
+    def compact(self):
+        """Переписывает index.json и обнуляет журнал индекса"""
+        write_atomic(self.index_path, json.dumps(self.index).encode("utf-8"), self.fsync)
+        if self._log_fd is not None:
+            os.ftruncate(self._log_fd, 0)
+        elif os.path.exists(self.log_path):
+            os.truncate(self.log_path, 0)
+        self._log_lines = 0
+
+    def close(self):
+        if self._log_fd is not None:
+            os.close(self._log_fd)
+            self._log_fd = None
+
+    def add(self, uid, record, cohort):
+        os.makedirs(self.archive_dir, exist_ok=True)
+        line = json.dumps({"uid": uid, "record": record}, ensure_ascii=False) + "\n"
+        member = gzip.compress(line.encode("utf-8"))
+        # Каждая запись — отдельный gzip-member; gzip читает склеенные member'ы как один поток
+        with open(self._cohort_path(cohort), "ab") as f:
+            offset = f.tell()
+            f.write(member)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        offsets = self._offsets.get(cohort)
+        if offsets is not None:
+            offsets[uid] = (offset, len(member))
+        self.index[uid] = cohort
+        self._log(uid, cohort)
+
+    def _iter_cohort(self, cohort, size=None):
+        path = self._cohort_path(cohort)
+        try:
+            with open(path, "rb") as raw:
+                # size — длина файла на момент снимка: дописанные позже записи не читаем
+                source = io.BytesIO(raw.read(size)) if size is not None else raw
+                with gzip.open(source, "rt", encoding="utf-8") as f:
+                    for line in f:
+                        entry = json.loads(line)
+                        yield entry["uid"], entry["record"]
+        except FileNotFoundError:
+            return
+        except (EOFError, gzip.BadGzipFile, ValueError) as e:
+            # Оборванная последняя запись (например, при падении процесса) — читаем что успели
+            logger.error("Архив %s повреждён в конце: %s", path, e)
+
+    def _scan_offsets(self, cohort):
+        """Один проход по файлу когорты: где лежит последняя запись каждого участника"""
+        offsets = {}
+        try:
+            with open(self._cohort_path(cohort), "rb") as f:
+                raw = f.read()
+        except FileNotFoundError:
+            return offsets
+        view = memoryview(raw)
+        pos = 0
+        while pos < len(raw):
+            member = zlib.decompressobj(wbits=31)
+            chunks = []
+            end = pos
+            try:
+                while not member.eof and end < len(raw):
+                    chunk = view[end:end + 65536]
+                    chunks.append(member.decompress(chunk))
+                    end += len(chunk)
+                if not member.eof:
+                    raise EOFError("оборванный gzip-member")
+                end -= len(member.unused_data)
+                uid = json.loads(b"".join(chunks))["uid"]
+            except (EOFError, zlib.error, ValueError, KeyError) as e:
+                logger.error("Архив %s повреждён в конце: %s", self._cohort_path(cohort), e)
+                break
+            offsets[uid] = (pos, end - pos)
+            pos = end
+        return offsets
+
+    def _read_member(self, cohort, offset, length):
+        with open(self._cohort_path(cohort), "rb") as f:
+            f.seek(offset)
+            raw = f.read(length)
+        return json.loads(gzip.decompress(raw))["record"]
+
+    def get(self, uid, index=None, sizes=None):
+        index = self.index if index is None else index
+        cohort = index.get(uid)
+        if cohort is None:
+            return None
+        offsets = self._offsets.get(cohort)
+        if offsets is None:
+            offsets = self._offsets[cohort] = self._scan_offsets(cohort)
+        location = offsets.get(uid)
+        limit = (sizes or {}).get(cohort)
+        if location is not None and (limit is None or sum(location) <= limit):
+            return self._read_member(cohort, *location)
+        # Участника перенесли в архив повторно уже после снимка — ищем его прежнюю версию
+        found = None
+        for archived_uid, record in self._iter_cohort(cohort, limit):
+            if archived_uid == uid:
+                found = record
+        return found
+
+    def remove(self, uid):
+        """Убирает участника из индекса (сами записи остаются в файле когорты)"""
+        if self.index.pop(uid, None) is not None:
+            self._log(uid, None)
+
+    def cohorts(self):
+        return sorted(set(self.index.values()))
+
+    def sizes(self):
+        """Длины файлов когорт — граница снимка архива"""
+        sizes = {}
+        for cohort in self.cohorts():
+            try:
+                sizes[cohort] = os.path.getsize(self._cohort_path(cohort))
+            except FileNotFoundError:
+                pass
+        return sizes
+
+    def iter_records(self, index=None, sizes=None):
+        """Все участники архива; index и sizes ограничивают обход состоянием на момент снимка"""
+        index = self.index if index is None else index
+        for cohort in sorted(set(index.values())):
+            latest = {}
+            for uid, record in self._iter_cohort(cohort, (sizes or {}).get(cohort)):
+                if index.get(uid) == cohort:
+                    latest[uid] = record
+            yield from latest.items()
+
+    def __len__(self):
+        return len(self.index)
+
+
+class ParticipantStore:
+    """Словарь участников (uid -> запись) поверх каталога с JSON-файлами"""
+
+    def __init__(self, data_dir, legacy_file=None, max_cached=10000, ttl=3600, archive_dir=None, journal=None,
+                 fsync=True):
+        self.data_dir = data_dir
+        self.journal = journal
+        self.fsync = fsync
+        self.archive = ParticipantArchive(archive_dir or os.path.join(data_dir, "archive"), fsync=fsync)
+        self.legacy_file = legacy_file
+        self.max_cached = max_cached
+        self.ttl = ttl
+        self.io = {"loads": 0, "saves": 0, "bytes_read": 0, "bytes_written": 0}
+        self.cache_stats = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0, "writebacks": 0}
+        self._records = OrderedDict()
+        self._touched = {}
+        self._dirty = set()
+        # Снимки: номер поколения растёт с каждым изменением; JSON изменённых записей
+        # переиспользуется следующим снимком, если запись с тех пор не менялась
+        self.generation = 0
+        self._changed = set()
+        self._frozen = {}
+        self._snapshots = weakref.WeakSet()
+        # Изменённые участники, которых ещё нет в журнале апдейтов
+        self._unjournaled = set()
+        # Участники, восстановленные из журнала при запуске (их ответы переиндексируются)
+        self.recovered = set()
+
+    def prepare(self):
+        """Создаёт каталог данных, переносит туда старый user_data.json и доигрывает журнал"""
+        os.makedirs(self.data_dir, exist_ok=True)
+        if self.legacy_file and os.path.exists(self.legacy_file):
+            self._migrate_legacy()
+        if self.journal is not None:
+            self._recover()
+
+    def _recover(self):
+        for uid, record in self.journal.recover().items():
+            if record is not None:
+                self._write(uid, record)
+                self.recovered.add(uid)
+            elif uid in self.archive.index:
+                # Участник уже в архиве, а файл не успели удалить
+                try:
+                    os.remove(self._path(uid))
+                except FileNotFoundError:
+                    pass
+        self.journal.checkpoint()
+
+    def _migrate_legacy(self):
+        try:
+            with open(self.legacy_file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except ValueError as e:
+            # Пустой словарь здесь означал бы, что все участники начнут заново
+            raise RuntimeError(f"{self.legacy_file} повреждён, перенос остановлен: {e}") from e
+        for uid, record in data.items():
+            if not os.path.exists(self._path(uid)):
+                self._write(uid, record)
+        os.replace(self.legacy_file, self.legacy_file + ".migrated")
+        logger.info("Перенесено %d участников из %s", len(data), self.legacy_file)
+
+    def _path(self, uid):
+        return os.path.join(self.data_dir, f"{uid}.json")
+
+    def _read(self, uid):
+        try:
+            with open(self._path(uid), "rb") as f:
+                raw = f.read()
+        except FileNotFoundError:
+            return None
+        self.io["loads"] += 1
+        self.io["bytes_read"] += len(raw)
+        return json.loads(raw.decode("utf-8"))
+
+    def _before_overwrite(self, uid):
+        """Открытые снимки сохраняют себе старую версию файла (copy-on-write)"""
+        for snapshot in list(self._snapshots):
+            snapshot._preserve(uid)
+
+    def _mark_changed(self, uid):
+        self.generation += 1
+        self._changed.add(uid)
+        if self.journal is not None:
+            self._unjournaled.add(uid)
+
+    def _write(self, uid, record):
+        if uid in self._unjournaled:
+            # В журнале должна быть версия не старше файла, иначе восстановление её откатит
+            self.journal.append(None, {uid: record})
+            self._unjournaled.discard(uid)
+        raw = json.dumps(record, ensure_ascii=False, indent=2).encode("utf-8")
+        if self._snapshots:
+            self._before_overwrite(uid)
+        write_atomic(self._path(uid), raw, self.fsync)
+        self.io["saves"] += 1
+        self.io["bytes_written"] += len(raw)
+
+    def _write_back(self, uid):
+        record = self._records.get(uid)
+        if record is None or uid not in self._dirty:
+            return
+        try:
+            self._write(uid, record)
+            self._dirty.discard(uid)
+        except Exception as e:
+            logger.exception("Ошибка при сохранении участника %s: %s", uid, e)
+
+    def _cache(self, uid, record):
+        self._records[uid] = record
+        self._records.move_to_end(uid)
+        self._touched[uid] = time.monotonic()
+        while len(self._records) > self.max_cached:
+            if not self._evict(next(iter(self._records))):
+                break
+            self.cache_stats["evictions"] += 1
+
+    def _evict(self, uid):
+        if uid in self._dirty:
+            self._write_back(uid)
+            self.cache_stats["writebacks"] += 1
+            if uid in self._dirty:
+                # Не удалось записать — оставляем в памяти, чтобы не потерять данные
+                self._records.move_to_end(uid)
+                return False
+        self._records.pop(uid, None)
+        self._touched.pop(uid, None)
+        return True
+
+    def uids(self):
+        """Все uid на диске и в памяти"""
+        on_disk = {name[:-5] for name in os.listdir(self.data_dir) if name.endswith(".json")}
+        return on_disk | set(self._records)
+
+    def get(self, uid, default=None):
+        record = self._records.get(uid)
+        if record is not None:
+            self.cache_stats["hits"] += 1
+            self._records.move_to_end(uid)
+            self._touched[uid] = time.monotonic()
+            return record
+        self.cache_stats["misses"] += 1
+        try:
+            record = self._read(uid)
+        except Exception as e:
+            # Не отдаём default: обработчик принял бы участника за нового и затёр бы его прогресс
+            logger.exception("Ошибка при загрузке участника %s: %s", uid, e)
+            raise
+        if record is None:
+            record = self.archive.get(uid)
+            if record is None:
+                return default
+            # Участник из архива снова пишет боту — возвращаем его в рабочее хранилище
+            self.archive.remove(uid)
+            self._cache(uid, record)
+            self._dirty.add(uid)
+            self._mark_changed(uid)
+            return record
+        self._cache(uid, record)
+        return record
+
+    def peek(self, uid, default=None):
+        """Запись участника только для чтения: кэш, диск или архив, без изменения кэша"""
+        record = self._records.get(uid)
+        if record is None:
+            try:
+                record = self._read(uid)
+            except Exception as e:
+                logger.exception("Ошибка при загрузке участника %s: %s", uid, e)
+        if record is None:
+            record = self.archive.get(uid)
+        return default if record is None else record
+
+    def __getitem__(self, uid):
+        record = self.get(uid)
+        if record is None:
+            raise KeyError(uid)
+        return record
+
+    def __setitem__(self, uid, record):
+        self._cache(uid, record)
+        self._dirty.add(uid)
+        self._mark_changed(uid)
+
+    def __contains__(self, uid):
+        return self.get(uid) is not None
+
+    def __len__(self):
+        return len(self.uids())
+
+    def save(self, uid, record=None):
+        """Помечает участника изменённым; на диск он попадёт при flush() или вытеснении.
+
+        record — запись, полученная обработчиком через get(). Пока обработчик ждал
+        сеть, её могли вытеснить из кэша; тогда она возвращается в кэш, иначе
+        изменения потерялись бы.
+        """
+        if record is not None and self._records.get(uid) is not record:
+            self._cache(uid, record)
+        if uid in self._records:
+            self._dirty.add(uid)
+            self._mark_changed(uid)
+
+    def archive_participant(self, uid, today):
+        """Переносит участника в архив и удаляет его из рабочего хранилища; today — как в cohort_of()"""
+        record = self.peek(uid)
+        if record is None:
+            return False
+        self.archive.add(uid, record, cohort_of(record, today))
+        self._records.pop(uid, None)
+        self._touched.pop(uid, None)
+        self._dirty.discard(uid)
+        self._mark_changed(uid)
+        if self.journal is not None:
+            self.journal.append(None, {uid: None})
+            self._unjournaled.discard(uid)
+        if self._snapshots:
+            self._before_overwrite(uid)
+        try:
+            os.remove(self._path(uid))
+        except FileNotFoundError:
+            pass
+        return True
+
+    def release(self, uid):
+        """Записывает участника и убирает его из кэша (например, после завершения недели)"""
+        self._evict(uid)
+
+    def commit(self, update_id=None):
+        """Записывает в журнал участников, изменённых апдейтом update_id (и заданиями до него)"""
+        if self.journal is None:
+            return
+        records = {uid: self._records[uid] for uid in self._unjournaled if uid in self._records}
+        self._unjournaled.clear()
+        self.journal.append(update_id, records)
+
+    def flush(self):
+        """Пишет на диск все изменённые записи и вытесняет давно не использованные"""
+        for uid in list(self._dirty):
+            self._write_back(uid)
+        if self.journal is not None and not self._dirty:
+            # Всё из журнала теперь в файлах участников
+            self.journal.checkpoint()
+
+        expire_before = time.monotonic() - self.ttl
+        for uid in list(self._records):
+            if self._touched.get(uid, 0) < expire_before and self._evict(uid):
+                self.cache_stats["expired"] += 1
+
+    async def warm(self, skip=None, batch_size=500):
+        """Заполняет кэш недавно изменёнными участниками (кроме тех, для кого skip(record) истинно)"""
+        paths = []
+        for entry in os.scandir(self.data_dir):
+            if entry.name.endswith(".json"):
+                paths.append((entry.stat().st_mtime, entry.name[:-5]))
+        paths.sort(reverse=True)
+
+        loaded = 0
+        for _, uid in paths:
+            if loaded >= self.max_cached:
+                break
+            if uid in self._records:
+                continue
+            try:
+                record = self._read(uid)
+            except Exception as e:
+                # Один испорченный файл не должен останавливать загрузку остальных
+                logger.exception("Ошибка при загрузке участника %s: %s", uid, e)
+                continue
+            if record is None or (skip and skip(record)):
+                continue
+            self._records[uid] = record
+            self._records.move_to_end(uid, last=False)
+            self._touched[uid] = time.monotonic()
+            loaded += 1
+            if loaded % batch_size == 0:
+                await asyncio.sleep(0)
+        return loaded
+
+    def iter_records(self):
+        """Проходит по всем участникам только для чтения, не засоряя кэш"""
+        for uid in sorted(self.uids()):
+            record = self._records.get(uid)
+            if record is None:
+                try:
+                    record = self._read(uid)
+                except Exception as e:
+                    logger.exception("Ошибка при загрузке участника %s: %s", uid, e)
+                    continue
+            if record is not None:
+                yield uid, record
+
+    def iter_all(self):
+        """Все участники, включая архивных (для админских выгрузок)"""
+        live = set()
+        for uid, record in self.iter_records():
+            live.add(uid)
+            yield uid, record
+        for uid, record in self.archive.iter_records():
+            if uid not in live:
+                yield uid, record
+
+    def to_dict(self, include_archive=False):
+        return dict(self.iter_all() if include_archive else self.iter_records())
+
+    def snapshot(self):
+        """Согласованный срез всех участников (вызывать из цикла событий; обходить можно из потока)"""
+        for uid in self._dirty:
+            if uid in self._changed or uid not in self._frozen:
+                self._frozen[uid] = json.dumps(self._records[uid], ensure_ascii=False).encode("utf-8")
+        for uid in [uid for uid in self._frozen if uid not in self._dirty]:
+            del self._frozen[uid]
+        self._changed.clear()
+
+        snapshot = StoreSnapshot(self, dict(self._frozen), self.uids(), dict(self.archive.index), self.archive.sizes())
+        self._snapshots.add(snapshot)
+        return snapshot
+
+    def metrics(self):
+        lookups = self.cache_stats["hits"] + self.cache_stats["misses"]
+        return {
+            **self.cache_stats,
+            "cached": len(self._records),
+            "dirty": len(self._dirty),
+            "hit_rate": round(self.cache_stats["hits"] / lookups, 4) if lookups else 0.0,
+        }
+
+
+class StoreSnapshot:
+    """Срез хранилища на момент создания, только для чтения.
+
+    Изменённые и ещё не записанные участники заморожены в JSON при создании
+    снимка, остальные читаются с диска по мере обхода. Если файл участника
+    перезаписывается или удаляется, пока снимок открыт, хранилище сначала
+    отдаёт снимку старое содержимое. Закрывается через close() или with.
+    """
+
+    def __init__(self, store, frozen, uids, archive_index, archive_sizes):
+        self.store = store
+        self.generation = store.generation
+        self.taken_at = time.time()
+        self._started = time.monotonic()
+        self._frozen = frozen
+        self._uids = uids
+        self._preserved = {}
+        self._lock = threading.Lock()
+        self._archive_index = archive_index
+        self._archive_sizes = archive_sizes
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.store._snapshots.discard(self)
+
+    def age(self):
+        """Сколько секунд прошло с момента среза"""
+        return time.monotonic() - self._started
+
+    def _preserve(self, uid):
+        if uid not in self._uids or uid in self._frozen:
+            return
+        with self._lock:
+            if uid not in self._preserved:
+                self._preserved[uid] = self._read_file(uid)
+
+    def _read_file(self, uid):
+        try:
+            with open(self.store._path(uid), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _load(self, uid):
+        raw = self._frozen.get(uid)
+        if raw is None:
+            with self._lock:
+                raw = self._preserved[uid] if uid in self._preserved else self._read_file(uid)
+        if raw is None:
+            return None
+        try:
+            return json.loads(raw.decode("utf-8"))
+        except ValueError as e:
+            logger.error("Снимок: не удалось прочитать участника %s: %s", uid, e)
+            return None
+
+    def peek(self, uid, default=None):
+        record = self._load(uid) if uid in self._uids else None
+        if record is None:
+            record = self.store.archive.get(uid, self._archive_index, self._archive_sizes)
+        return default if record is None else record
+
+    def iter_records(self):
+        for uid in sorted(self._uids):
+            record = self._load(uid)
+            if record is not None:
+                yield uid, record
+
+    def iter_all(self):
+        live = set()
+        for uid, record in self.iter_records():
+            live.add(uid)
+            yield uid, record
+        for uid, record in self.store.archive.iter_records(self._archive_index, self._archive_sizes):
+            if uid not in live:
+                yield uid, record
+
+    def to_dict(self, include_archive=False):
+        return dict(self.iter_all() if include_archive else self.iter_records())
+
+    @property
+    def archived(self):
+        return len(self._archive_index)
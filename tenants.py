@@ -0,0 +1,243 @@
+"""Несколько исследований (ботов) в одном процессе.
+
+Study — всё, что относится к одному боту: токен, админ, хранилище
+участников, поисковый индекс, каталог медиа, сценарий (модуль с текстами,
+как days.py) и входящий лимит. Код обработчиков обращается к текущему
+исследованию через прокси (USER_DATA, SCRIPT и т.д. в main.py), а текущее
+исследование задаётся contextvar'ом на входе в апдейт или задание.
+
+Общая инфраструктура для всех ботов процесса: цикл событий, пул HTTP-
+соединений (SharedRequest), диспетчер исходящих (один PriorityRateLimiter),
+планировщик (SharedJobQueue поверх одного AsyncIOScheduler) и одна
+фоновая запись на диск.
+
+Конфигурация — JSON-файл со списком исследований:
+    [{"name": "spring", "token_env": "TOKEN_SPRING", "admin_id": 123, "script": "days"}]
+"""
+import contextvars
+import functools
+import importlib
+import json
+import logging
+import os
+import re
+
+from telegram import Update
+from telegram.ext import Job, JobQueue, TypeHandler
+from telegram.request import BaseRequest
+
+from inbound import InboundLimiter
+from journal import UpdateJournal
+from search import SearchIndex
+from storage import ParticipantStore
+
+logger = logging.getLogger(__name__)
+
+CURRENT_STUDY = contextvars.ContextVar("study")
+
+# Исследование по умолчанию — для обычного запуска с одним ботом
+_default = None
+
+
+class Study:
+    """Один бот-исследование со своими данными и сценарием"""
+
+    def __init__(self, name, token, admin_id=None, data_dir=None, archive_dir=None, media_dir=None,
+                 legacy_file=None, script="days", max_cached=10000, ttl=3600, inbound=None, fsync=True):
+        self.name = name
+        self.token = token
+        self.admin_id = admin_id
+        self.data_dir = data_dir
+        self.media_dir = media_dir
+        self.script = importlib.import_module(script)
+        self.journal = UpdateJournal(data_dir, fsync=fsync)
+        self.store = ParticipantStore(data_dir, legacy_file=legacy_file, max_cached=max_cached, ttl=ttl,
+                                      archive_dir=archive_dir, journal=self.journal, fsync=fsync)
+        self.search = SearchIndex(os.path.join(data_dir, "search.sqlite3"))
+        self.inbound = InboundLimiter(**(inbound or {}))
+        if admin_id:
+            self.inbound.exempt.add(admin_id)
+        self.stats_cache = {"text": None, "at": 0.0, "taken_at": 0.0}
+
+    @classmethod
+    def in_dir(cls, name, token, base_dir, **kwargs):
+        """Исследование с каталогами studies/<name>/{user_data,archive,user_media}"""
+        root = os.path.join(base_dir, "studies", name)
+        return cls(name, token, data_dir=os.path.join(root, "user_data"),
+                   archive_dir=os.path.join(root, "archive"), media_dir=os.path.join(root, "user_media"), **kwargs)
+
+    def prepare(self):
+        self.store.prepare()
+        os.makedirs(self.media_dir, exist_ok=True)
+        # Ответы из журнала могли не успеть попасть в поиск; пустой индекс и так перестроится целиком
+        if self.store.recovered and len(self.search):
+            records = ((uid, self.store.peek(uid)) for uid in sorted(self.store.recovered))
+            indexed = self.search.reindex((uid, record) for uid, record in records if record is not None)
+            logger.info("Исследование %s: переиндексировано участников из журнала: %d", self.name, indexed)
+
+    def flush(self):
+        # Сначала поиск: flush() хранилища обнуляет журнал, по которому поиск восстанавливается
+        self.search.flush()
+        self.store.flush()
+
+    def close(self):
+        self.search.close()
+        self.store.flush()
+        self.store.archive.close()
+        self.journal.close()
+
+
+def set_default_study(study):
+    global _default
+    _default = study
+
+
+def current_study():
+    """Исследование, в контексте которого выполняется код"""
+    study = CURRENT_STUDY.get(None) or _default
+    if study is None:
+        raise LookupError("не выбрано текущее исследование")
+    return study
+
+
+def bind_study(callback):
+    """Обёртка задания JobQueue: выполняет его в контексте исследования своего бота"""
+    @functools.wraps(callback)
+    async def wrapper(context):
+        token = CURRENT_STUDY.set(context.application.bot_data["study"])
+        try:
+            return await callback(context)
+        finally:
+            CURRENT_STUDY.reset(token)
+    return wrapper
+
+
+async def enter_study(update, context):
+    """Первый обработчик апдейта: дальше апдейт обрабатывается в контексте исследования своего бота"""
+    CURRENT_STUDY.set(context.application.bot_data["study"])
+
+
+def study_handler():
+    """Обработчик для application.add_handler(..., group=-2), раньше входящего лимита"""
+    return TypeHandler(Update, enter_study)
+
+
+class StudyProxy:
+    """Атрибут текущего исследования, доступный как обычный объект модуля"""
+
+    __slots__ = ("_attr",)
+
+    def __init__(self, attr=None):
+        self._attr = attr
+
+    def _target(self):
+        study = current_study()
+        return getattr(study, self._attr) if self._attr else study
+
+    def __getattr__(self, name):
+        return getattr(self._target(), name)
+
+    def __getitem__(self, key):
+        return self._target()[key]
+
+    def __setitem__(self, key, value):
+        self._target()[key] = value
+
+    def __contains__(self, key):
+        return key in self._target()
+
+    def __iter__(self):
+        return iter(self._target())
+
+    def __len__(self):
+        return len(self._target())
+
+
+def load_studies(path, base_dir, **defaults):
+    """Исследования из JSON-конфигурации"""
+    with open(path, "r", encoding="utf-8") as f:
+        config = json.load(f)
+
+    studies = []
+    for entry in config:
+        name = entry["name"]
+        if not re.fullmatch(r"[\w-]+", name):
+            raise ValueError(f"Недопустимое имя исследования: {name!r}")
+        token = entry.get("token") or os.environ.get(entry.get("token_env", ""))
+        if not token:
+            raise ValueError(f"Нет токена для исследования {name}")
+        admin_id = entry.get("admin_id")
+        studies.append(Study.in_dir(
+            name, token, base_dir,
+            admin_id=int(admin_id) if admin_id else None,
+            script=entry.get("script", "days"),
+            **defaults,
+        ))
+    return studies
+
+
+class SharedRequest(BaseRequest):
+    """Один пул HTTP-соединений на все боты процесса (закрывается последним ботом)"""
+
+    def __init__(self, request):
+        self._request = request
+        self._users = 0
+
+    @property
+    def read_timeout(self):
+        return self._request.read_timeout
+
+    async def initialize(self):
+        if self._users == 0:
+            await self._request.initialize()
+        self._users += 1
+
+    async def shutdown(self):
+        self._users -= 1
+        if self._users == 0:
+            await self._request.shutdown()
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        return await self._request.do_request(
+            url, method, request_data=request_data, read_timeout=read_timeout, write_timeout=write_timeout,
+            connect_timeout=connect_timeout, pool_timeout=pool_timeout,
+        )
+
+
+class SharedJobQueue(JobQueue):
+    """JobQueue бота поверх общего для процесса планировщика APScheduler.
+
+    Каждая очередь видит только свои задания (имена вида reminder_<chat_id>
+    у разных ботов совпадают), планировщик останавливается вместе с последней.
+    Все очереди должны быть созданы до запуска планировщика.
+    """
+
+    _shared = {}
+
+    def __init__(self, scheduler):
+        super().__init__()
+        self.scheduler = scheduler
+        # Исполнитель тоже общий: иначе stop() ждал бы только задания своей очереди
+        shared = SharedJobQueue._shared.setdefault(id(scheduler), {"executor": self._executor, "users": 0})
+        self._executor = shared["executor"]
+
+    def jobs(self, pattern=None):
+        pattern = re.compile(pattern) if pattern is not None else None
+        return tuple(
+            Job.from_aps_job(aps_job) for aps_job in self.scheduler.get_jobs()
+            if aps_job.args and aps_job.args[0] is self
+            and (pattern is None or (aps_job.name and pattern.search(aps_job.name)))
+        )
+
+    async def start(self):
+        SharedJobQueue._shared[id(self.scheduler)]["users"] += 1
+        await super().start()
+
+    async def stop(self, wait=True):
+        for job in self.jobs():
+            job.schedule_removal()
+        shared = SharedJobQueue._shared[id(self.scheduler)]
+        shared["users"] = max(0, shared["users"] - 1)
+        if shared["users"] == 0:
+            await super().stop(wait)
@@ -0,0 +1,51 @@
+import asyncio
+
+import compose
+from compose import MESSAGE_LIMIT, compose as compose_parts, part
+
+
+def test_plain_text_is_escaped_when_merged_with_html():
+    sends = compose_parts([part("<b>День 2</b>", "HTML"), part("a < b", None)])
+    assert sends == [part("<b>День 2</b>\n\na &lt; b", "HTML")]
+
+
+def test_keyboard_goes_with_merged_message_but_two_keyboards_split():
+    keyboard, other = object(), object()
+    assert compose_parts([part("раз"), part("два", reply_markup=keyboard)]) == [
+        part("раз\n\nдва", reply_markup=keyboard)]
+    assert compose_parts([part("раз", reply_markup=keyboard), part("два", reply_markup=other)]) == [
+        part("раз", reply_markup=keyboard), part("два", reply_markup=other)]
+
+
+def test_markdown_is_not_merged_with_html():
+    parts = [part("*жирный*", "MarkdownV2"), part("<b>жирный</b>", "HTML")]
+    assert compose_parts(parts) == parts
+
+
+def test_text_over_telegram_limit_is_split_in_order():
+    first = part("а" * (MESSAGE_LIMIT - 10))
+    second = part("б" * 20)
+    third = part("в")
+    sends = compose_parts([first, second, third])
+    assert sends == [first, part(second["text"] + "\n\n" + third["text"])]
+    assert all(len(p["text"]) <= MESSAGE_LIMIT for p in sends)
+    # Ровно на границе лимита ещё склеивается
+    exact = part("г" * (MESSAGE_LIMIT - 2 - 1))
+    assert compose_parts([exact, part("д")]) == [part(exact["text"] + "\n\nд")]
+
+
+def test_send_composed_sends_in_order_and_counts_saved_requests():
+    sent = []
+
+    class Bot:
+        async def send_message(self, chat_id, **kwargs):
+            sent.append((chat_id, kwargs["text"], kwargs.get("rate_limit_args")))
+            return len(sent)
+
+    before = dict(compose.METRICS)
+    parts = [part("раз", "HTML"), part("два", "HTML"), part("*три*", "MarkdownV2")]
+    asyncio.run(compose.send_composed(Bot(), 7, parts, rate_limit_args={"lane": "day_message"}))
+
+    assert sent == [(7, "раз\n\nдва", {"lane": "day_message"}), (7, "*три*", {"lane": "day_message"})]
+    assert compose.METRICS["parts"] - before["parts"] == 3
+    assert compose.METRICS["sends"] - before["sends"] == 2
@@ -0,0 +1,14 @@
+from inbound import InboundLimiter
+
+
+def test_overflow_passes_updates_over_chat_limit_only():
+    limiter = InboundLimiter(rate=0.001, burst=2, global_rate=3)
+    assert limiter.allow(1) and limiter.allow(1)
+    assert not limiter.allow(1)
+    assert not limiter.allow(1, overflow=lambda: False)
+    assert limiter.allow(1, overflow=lambda: True)
+    # Общий потолок действует и на такие апдейты
+    assert not limiter.allow(1, overflow=lambda: True)
+    assert limiter.metrics["overflow_passed"] == 1
+    assert limiter.metrics["dropped_chat"] == 2
+    assert limiter.metrics["dropped_global"] == 1
@@ -0,0 +1,73 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+from telegram.ext import ApplicationHandlerStop
+
+from journal import UpdateJournal
+from storage import ParticipantStore
+
+
+def test_recover_skips_torn_last_line(tmp_path):
+    journal = UpdateJournal(str(tmp_path), fsync=False)
+    journal.append(1, {"a": {"day": 1}})
+    journal.append(2, {"a": {"day": 2}, "b": {"day": 1}})
+    journal.close()
+    with open(journal.path, "ab") as f:
+        f.write(b'{"u": 3, "r": {"a": {"da')  # процесс убит посреди записи
+
+    reopened = UpdateJournal(str(tmp_path), fsync=False)
+    assert reopened.recover() == {"a": {"day": 2}, "b": {"day": 1}}
+    assert reopened.metrics["replayed"] == 2
+    assert reopened.seen(1) and reopened.seen(2) and not reopened.seen(3)
+
+
+def test_checkpoint_truncates_journal_and_keeps_seen_updates(tmp_path):
+    journal = UpdateJournal(str(tmp_path), fsync=False)
+    journal.append(10, {"a": {"day": 1}})
+    journal.append(11, {})
+    journal.checkpoint()
+    journal.close()
+
+    with open(journal.path, "rb") as f:
+        assert f.read() == b""
+    with open(journal.checkpoint_path, encoding="utf-8") as f:
+        assert json.load(f) == {"last_update_id": 11, "recent": [10, 11]}
+
+    reopened = UpdateJournal(str(tmp_path), fsync=False)
+    assert reopened.recover() == {}
+    assert reopened.seen(10) and reopened.seen(11)
+
+
+def test_guard_stops_redelivered_update(tmp_path):
+    journal = UpdateJournal(str(tmp_path), fsync=False)
+    guard, commit = journal.handlers(store=None)
+    journal.append(5, {})
+
+    with pytest.raises(ApplicationHandlerStop):
+        asyncio.run(guard.callback(SimpleNamespace(update_id=5), None))
+    assert asyncio.run(guard.callback(SimpleNamespace(update_id=6), None)) is None
+    assert journal.metrics["duplicates"] == 1
+
+
+def test_store_recovers_committed_changes_after_crash(tmp_path):
+    data_dir = str(tmp_path / "user_data")
+
+    def open_store():
+        store = ParticipantStore(data_dir, archive_dir=str(tmp_path / "archive"),
+                                 journal=UpdateJournal(data_dir, fsync=False), fsync=False)
+        store.prepare()
+        return store
+
+    store = open_store()
+    store["a"] = {"day": 1}
+    store.flush()
+    store.get("a")["day"] = 2
+    store.save("a")
+    store.commit(42)
+    # Падение до flush(): файл участника старый, изменение есть только в журнале
+
+    recovered = open_store()
+    assert recovered.get("a") == {"day": 2}
+    assert recovered.journal.seen(42)
@@ -0,0 +1,57 @@
+import asyncio
+import time
+
+import pytest
+from telegram.error import Forbidden
+
+from outbox import PriorityRateLimiter
+
+
+async def send(limiter, sent, chat_id, lane=None, error=None):
+    async def callback():
+        if error is not None:
+            raise error
+        sent.append((chat_id, lane))
+
+    rate_limit_args = {"lane": lane} if lane else None
+    await limiter.process_request(callback, (), {}, "sendMessage", {"chat_id": chat_id}, rate_limit_args)
+
+
+def test_lanes_are_served_by_priority():
+    async def scenario():
+        limiter = PriorityRateLimiter(overall_rate=0, chat_rate=0)
+        await limiter.initialize()
+        sent = []
+        # Пауза как после RetryAfter: пока она идёт, запросы копятся в очередях
+        limiter._paused_until = time.monotonic() + 0.2
+        await asyncio.gather(*(send(limiter, sent, i, lane)
+                               for i, lane in enumerate(["apology", "reminder", None, "day_message", "unknown"])))
+        await limiter.shutdown()
+        return sent
+
+    assert asyncio.run(scenario()) == [(2, None), (4, "unknown"), (3, "day_message"), (1, "reminder"), (0, "apology")]
+
+
+def test_busy_chat_does_not_hold_back_other_chats():
+    async def scenario():
+        limiter = PriorityRateLimiter(overall_rate=0, chat_rate=10, chat_burst=1)
+        await limiter.initialize()
+        sent = []
+        await asyncio.gather(send(limiter, sent, 1), send(limiter, sent, 1), send(limiter, sent, 2))
+        await limiter.shutdown()
+        return [chat_id for chat_id, _ in sent]
+
+    assert asyncio.run(scenario()) == [1, 2, 1]
+
+
+def test_failures_are_counted_by_kind():
+    async def scenario():
+        limiter = PriorityRateLimiter(overall_rate=0, chat_rate=0)
+        await limiter.initialize()
+        with pytest.raises(Forbidden):
+            await send(limiter, [], 1, "reminder", Forbidden("bot was blocked by the user"))
+        await limiter.shutdown()
+        return limiter.metrics["reminder"]
+
+    stats = asyncio.run(scenario())
+    assert stats["failed"] == 1 and stats["errors"]["forbidden"] == 1
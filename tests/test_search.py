@@ -0,0 +1,14 @@
+from search import SearchIndex
+
+
+def test_reindex_adds_answers_missing_from_index(tmp_path):
+    index = SearchIndex(str(tmp_path / "search.sqlite3"))
+    index.reindex([("a", {"day": 1})])
+    record = {"responses": {"2026-01-05": [{"text": "Пятно на рубашке", "day": 1}]}}
+
+    assert index.reindex([("a", record)]) == 1
+    assert [hit["uid"] for hit in index.search("пятна")] == ["a"]
+    # Повторная индексация обновляет, а не дублирует
+    index.reindex([("a", record)])
+    assert len(index) == 1
+    index.close()
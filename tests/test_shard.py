@@ -0,0 +1,79 @@
+import asyncio
+import json
+import os
+
+from shard import Front, redistribute, serve_json, shard_for
+
+
+def write_json(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+
+
+def shard_files(tmp_path, count):
+    return [
+        sorted(name[:-5] for name in os.listdir(tmp_path / "user_data" / f"shard_{i}") if name.endswith(".json"))
+        if (tmp_path / "user_data" / f"shard_{i}").exists() else []
+        for i in range(count)
+    ]
+
+
+def test_redistribute_splits_legacy_file_and_unsharded_files(tmp_path):
+    uids = [str(100 + i) for i in range(20)]
+    write_json(str(tmp_path / "user_data.json"), {uid: {"day": 1} for uid in uids[:10]})
+    for uid in uids[10:]:
+        write_json(str(tmp_path / "user_data" / f"{uid}.json"), {"day": 2})
+
+    redistribute(str(tmp_path), 3)
+
+    files = shard_files(tmp_path, 3)
+    for i, owned in enumerate(files):
+        assert all(shard_for(uid, 3) == i for uid in owned)
+    assert sorted(sum(files, [])) == uids
+    assert not (tmp_path / "user_data.json").exists()
+    assert (tmp_path / "user_data.json.migrated").exists()
+    assert not [name for name in os.listdir(tmp_path / "user_data") if name.endswith(".json")]
+
+
+def test_redistribute_moves_files_after_shard_count_change(tmp_path):
+    uids = [str(200 + i) for i in range(20)]
+    for uid in uids:
+        write_json(str(tmp_path / "user_data" / f"shard_{shard_for(uid, 2)}" / f"{uid}.json"), {"day": 3})
+
+    redistribute(str(tmp_path), 4)
+
+    files = shard_files(tmp_path, 4)
+    for i, owned in enumerate(files):
+        assert all(shard_for(uid, 4) == i for uid in owned)
+    assert sorted(sum(files, [])) == uids
+
+
+def test_front_acknowledges_update_only_after_worker_accepts_it():
+    async def scenario():
+        received = []
+        accept = asyncio.Event()
+
+        async def worker(method, path, payload, headers):
+            await accept.wait()
+            received.append(payload["update_id"])
+            return 200, {"ok": True}
+
+        server = await serve_json(worker, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        front = Front([f"http://127.0.0.1:{port}"])
+        tasks = front.start()
+        try:
+            forwarded = front.route({"update_id": 1, "message": {"chat": {"id": 5}}})
+            await asyncio.sleep(0.1)
+            assert not forwarded.done()
+            accept.set()
+            await asyncio.wait_for(forwarded, 5)
+            assert received == [1]
+        finally:
+            for task in tasks:
+                task.cancel()
+            await front.client.aclose()
+            server.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,101 @@
+import asyncio
+import json
+
+from storage import ParticipantStore
+
+
+def make_store(tmp_path, **kwargs):
+    store = ParticipantStore(str(tmp_path / "user_data"), archive_dir=str(tmp_path / "archive"), **kwargs)
+    store.prepare()
+    return store
+
+
+def read_file(store, uid):
+    with open(store._path(uid), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def test_save_keeps_changes_of_record_evicted_while_in_use(tmp_path):
+    store = make_store(tmp_path, max_cached=2)
+    for uid in "abc":
+        store[uid] = {"day": 1}
+    store.flush()
+
+    a = store.get("a")
+    store.get("b")
+    store.get("c")  # «a» вытеснена, пока обработчик держит ссылку на неё
+    assert "a" not in store._records
+
+    a["day"] = 2
+    store.save("a", a)
+    store.flush()
+
+    assert read_file(store, "a")["day"] == 2
+    assert store.get("a")["day"] == 2
+
+
+def test_warm_skips_unreadable_record(tmp_path):
+    store = make_store(tmp_path)
+    for uid in ("a", "b"):
+        store[uid] = {"day": 1}
+    store.flush()
+    with open(store._path("a"), "w", encoding="utf-8") as f:
+        f.write("{обрыв")
+
+    cold = make_store(tmp_path)
+    assert asyncio.run(cold.warm()) == 1
+    assert "b" in cold._records
+
+
+def test_prepare_reports_uids_recovered_from_journal(tmp_path):
+    from journal import UpdateJournal
+
+    data_dir = tmp_path / "user_data"
+    data_dir.mkdir()
+    journal = UpdateJournal(str(data_dir), fsync=False)
+    journal.append(7, {"a": {"day": 2}, "b": None})
+    journal.close()
+
+    store = make_store(tmp_path, journal=UpdateJournal(str(data_dir), fsync=False))
+    assert store.recovered == {"a"}
+    assert read_file(store, "a") == {"day": 2}
+
+
+def test_archive_index_survives_reopen_and_compaction(tmp_path):
+    from storage import ParticipantArchive
+
+    archive = ParticipantArchive(str(tmp_path), fsync=False)
+    archive.COMPACT_LINES = 3
+    for uid in "abcde":
+        archive.add(uid, {"started_date": "2026-01-05", "day": uid}, "2026-W02")
+    archive.remove("b")
+    archive.close()
+    with open(archive.log_path, "ab") as f:
+        f.write(b'["f", "2026-W0')  # оборванная последняя строка
+
+    reopened = ParticipantArchive(str(tmp_path))
+    assert sorted(reopened.index) == ["a", "c", "d", "e"]
+    assert reopened.get("d") == {"started_date": "2026-01-05", "day": "d"}
+    assert reopened.get("b") is None
+
+
+def test_archive_get_respects_snapshot_size(tmp_path):
+    from storage import ParticipantArchive
+
+    archive = ParticipantArchive(str(tmp_path), fsync=False)
+    archive.add("a", {"started_date": "2026-01-05", "day": 7}, "2026-W02")
+    archive.add("b", {"started_date": "2026-01-05", "day": 7}, "2026-W02")
+    index, sizes = dict(archive.index), archive.sizes()
+    assert archive.get("a") == {"started_date": "2026-01-05", "day": 7}
+    archive.add("a", {"started_date": "2026-01-05", "day": 8}, "2026-W02")
+
+    assert archive.get("a")["day"] == 8
+    assert archive.get("a", index, sizes)["day"] == 7
+
+
+def test_cohort_of_uses_given_date_only_for_records_without_dates():
+    from storage import cohort_of
+
+    assert cohort_of({"started_date": "2026-01-05"}, "2026-03-02") == "2026-W02"
+    assert cohort_of({"responses": {"2026-01-07": []}}, "2026-03-02") == "2026-W02"
+    assert cohort_of({}, "2026-03-02") == "2026-W10"